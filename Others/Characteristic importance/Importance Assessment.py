@@ -8,16 +8,19 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 
-from Utils.io import load_model, read_img
+from Utils.dataset import Dataset
+from Utils.io import load_model
 
 if __name__ == "__main__":
     ROOT = f"D:/new_data/test_1/image_RF_FJ_1_0125"
     sum_225 = []
     sum_256 = []
 
+    train_set = Dataset(f"{ROOT}/train", "Single", feature_num=256)
+    test_set = Dataset(f"{ROOT}/test", "Single", feature_num=256)
     for concentration in ['10^4', '10^5', '10^6', 'all']:
-        X_train, y_train = read_img(f"{ROOT}/train", "Single", concentration, feature_num=256)
-        X_test, y_test = read_img(f"{ROOT}/test", "Single", concentration, feature_num=256)
+        X_train, y_train = train_set.subset(concentration)
+        X_test, y_test = test_set.subset(concentration)
 
         model_rf = load_model(f"model/rf_{concentration}.pkl")
         model_rf.fit(X_train, y_train)
@@ -1,67 +1,162 @@
 """
 This script is used to find the peak value for every row in the file, and then calculate
 the mean value and the 95% confidence interval.
+
+The peaks of all the rows of a file are found at once: local_maxima() finds the local maxima of
+every row of the spectra matrix, with the same rules as scipy.signal.find_peaks (a flat peak is at
+the middle of its plateau), and nearest_peaks() keeps, for every row, the peak in the window
+nearest to the reference peak. When the fitted mean spectrum has no peak in the window, the
+highest peak of the mean spectrum in the window is used and a warning is printed, instead of
+asking for the value. The files are processed in parallel and result.csv is written at the end.
+
+The value that used to be typed in can be given with --peak FILE=VALUE, FILE being the name of the
+file without .xlsx, and it replaces the reference peak of that file. The column source of
+result.csv tells where the reference peak of every file comes from: "fitted", "fallback" or
+"manual". The reference peaks that were typed in for ECL_13_106 and EFA_13_104 are given with
+
+    python "Find peaks.py" --peak ECL_13_106=255 --peak EFA_13_104=261
+
+Usage:
+    python "Find peaks.py" [--root ./wave_length_data] [--output result.csv] [--workers 8]
+                           [--peak FILE=VALUE ...]
 """
+import argparse
 import os
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import pandas as pd
-from matplotlib import pyplot as plt
-from scipy.signal import find_peaks
 
+LOW, HIGH = 30, 270
+
+
+def local_maxima(spectra):
+    """
+    Find the local maxima of every row of a matrix, as scipy.signal.find_peaks does for one row.
+
+    A maximum is a sample, or a plateau of equal samples, higher than its neighbours on both sides.
+    The first and last samples are never maxima, and a plateau is reported at its middle (rounded
+    down).
+
+    Args:
+        spectra: A 2D ndarray, one spectrum per row.
+
+    Returns:
+        A boolean ndarray of the shape of spectra, True at the maxima.
+    """
+    n, m = spectra.shape
+    slope = np.sign(np.diff(spectra, axis=1))
+    # the index of the first non-flat step at or after every step, m - 1 if there is none
+    steps = np.where(slope != 0, np.arange(m - 1), m - 1)
+    next_step = np.minimum.accumulate(steps[:, ::-1], axis=1)[:, ::-1]
+
+    # a plateau starts at i after a rise, and ends at the step k where the samples fall again
+    rows, starts = np.nonzero(slope[:, :-1] == 1)
+    starts += 1
+    ends = next_step[rows, starts]
+    falls = ends < m - 1
+    rows, starts, ends = rows[falls], starts[falls], ends[falls]
+    falls = slope[rows, ends] == -1
+    maxima = np.zeros((n, m), dtype=bool)
+    maxima[rows[falls], (starts[falls] + ends[falls]) // 2] = True
+    return maxima
 
-def findNearMid(arr, mid):
-    """find the value in arr which is nearest to mid."""
-    if len(arr) == 0:
-        return -1
-    return arr[np.argmin(np.abs(arr - mid))]
 
+def nearest_peaks(maxima, reference):
+    """
+    For every row, the position of the maximum nearest to reference, the first one on a tie.
 
-def findAllPeaks(file):
-    """find all peaks for every row in the file."""
-    df = pd.read_excel(file, header=None)
+    Args:
+        maxima: A boolean ndarray, see local_maxima().
+        reference: The reference position.
+
+    Returns:
+        A ndarray of positions, -1 for the rows without maxima.
+    """
+    distance = np.where(maxima, np.abs(np.arange(maxima.shape[1]) - reference), np.inf)
+    return np.where(maxima.any(axis=1), np.argmin(distance, axis=1), -1)
+
+
+def findAllPeaks(file, peak=None):
+    """
+    find all peaks for every row in the file.
+
+    Args:
+        file: The path of the xlsx file, one spectrum per row.
+        peak: The reference peak, which replaces the one found on the mean spectrum. The default
+         is None, which finds it.
+
+    Returns:
+        single_peaks: The peak of every row.
+        source: Where the reference peak comes from, "fitted", "fallback" or "manual".
+    """
+    spectra = pd.read_excel(file, header=None).to_numpy(dtype=np.float64)
     # determine the peak value corresponding to the average data
-    mean = df.mean(axis=0)
-    pf = np.polyfit(np.arange(len(mean)), mean, 9)
-    pf_val = np.polyval(pf, np.arange(len(mean)))
-    peaks, _ = find_peaks(pf_val)
-
-    filtered_peaks = peaks[np.where(peaks < 270)]
-    filtered_peaks = filtered_peaks[np.where(filtered_peaks > 30)]
-    if filtered_peaks.size != 1:
-        if filtered_peaks.size > 1:
-            filtered_peaks = np.array([peaks[0]])
-        if filtered_peaks.size == 0:
-            plt.plot(mean)
-            plt.show()
-            filtered_peaks = np.array([float(input("input the peak value: "))])
-    new_peaks, _ = find_peaks(mean)
-    new_peaks = findNearMid(new_peaks, filtered_peaks[0])
+    mean = np.nanmean(spectra, axis=0)
+    x = np.arange(len(mean))
+    pf_val = np.polyval(np.polyfit(x, mean, 9), x)
+    peaks = np.flatnonzero(local_maxima(pf_val[np.newaxis])[0])
+
+    filtered_peaks = peaks[(peaks > LOW) & (peaks < HIGH)]
+    if filtered_peaks.size > 1:
+        filtered_peaks = peaks[:1]
+    mean_maxima = local_maxima(mean[np.newaxis])
+    source = "fitted"
+    if peak is not None:
+        filtered_peaks = np.array([peak])
+        source = "manual"
+    elif filtered_peaks.size == 0:
+        window = np.where(mean_maxima[0, LOW + 1:HIGH], mean[LOW + 1:HIGH], -np.inf)
+        if not np.isfinite(window).any():
+            window = mean[LOW + 1:HIGH]
+        filtered_peaks = np.array([LOW + 1 + np.argmax(window)])
+        print(f"warning: {os.path.basename(file)} has no fitted peak in ({LOW}, {HIGH}), "
+              f"the highest peak of the mean {filtered_peaks[0]} is used, see --peak")
+        source = "fallback"
+    new_peaks = nearest_peaks(mean_maxima, filtered_peaks[0])[0]
 
     # determine the peak value for every single row
-    single_peaks = []
-    for i, row in df.iterrows():
-        r = np.array(row)
-        single_peak, _ = find_peaks(r)
-        single_peak = single_peak[np.where(single_peak < 270)]
-        single_peak = single_peak[np.where(single_peak > 30)]
-        single_peak = findNearMid(single_peak, new_peaks)
+    maxima = local_maxima(spectra)
+    maxima[:, :LOW + 1] = False
+    maxima[:, HIGH:] = False
+    single_peaks = nearest_peaks(maxima, new_peaks)
+    single_peaks[single_peaks == -1] = round(new_peaks)
+    return single_peaks, source
+
+
+def summary(file, peak=None):
+    """The mean and the 95% confidence interval of the peaks of a file, as a line of result.csv."""
+    final_peaks, source = findAllPeaks(file, peak)
+    mean = final_peaks.mean()
+    low = np.percentile(final_peaks, 2.5)
+    high = np.percentile(final_peaks, 97.5)
+    return (f"{os.path.basename(file).removesuffix('.xlsx')},{round(mean, 3)},"
+            f"{round(low, 3)},{round(high, 3)},{round((high - low) / 2, 3)},{source}\n")
 
-        if single_peak == -1:
-            single_peak = round(new_peaks)
-        single_peaks.append(single_peak)
-    return np.array(single_peaks)
+
+def parse_peak(text):
+    """Parse a FILE=VALUE argument of --peak."""
+    name, sep, value = text.partition("=")
+    if not sep:
+        raise argparse.ArgumentTypeError(f"{text} is not FILE=VALUE")
+    return name.removesuffix(".xlsx"), float(value)
 
 
 if __name__ == '__main__':
-    root = "./wave_length_data"
-    f = open("result.csv", "w", encoding="utf-8")
-    f.write("filename,mean,low,high,halfLength\n")
-    for file in os.listdir(root):
-        final_peaks = findAllPeaks(os.path.join(root, file))
-        mean = final_peaks.mean()
-        low = np.percentile(final_peaks, 2.5)
-        high = np.percentile(final_peaks, 97.5)
-        f.write(f"{file.removesuffix('.xlsx')},{round(mean, 3)},"
-                f"{round(low, 3)},{round(high, 3)},{round((high - low) / 2, 3)}\n")
-    f.close()
+    parser = argparse.ArgumentParser(description="Find the peaks of the wavelength spectra.")
+    parser.add_argument("--root", default="./wave_length_data")
+    parser.add_argument("--output", default="result.csv")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--peak", type=parse_peak, action="append", default=[], metavar="FILE=VALUE",
+                        help="the reference peak of a file, instead of the one found")
+    args = parser.parse_args()
+
+    overrides = dict(args.peak)
+    files = [os.path.join(args.root, file) for file in sorted(os.listdir(args.root))]
+    peaks = [overrides.pop(os.path.basename(file).removesuffix(".xlsx"), None) for file in files]
+    if overrides:
+        parser.error(f"--peak of files not in {args.root}: {', '.join(overrides)}")
+    with ProcessPoolExecutor(args.workers) as executor:
+        lines = list(executor.map(summary, files, peaks))
+    with open(args.output, "w", encoding="utf-8") as f:
+        f.write("filename,mean,low,high,halfLength,source\n" + "".join(lines))
@@ -1,6 +1,11 @@
 """
 This script is used to merge three pictures into one picture. The three pictures are corresponding to three different
 diameters of nanoparticles.
+
+The merged images are only needed to be read back by read_img(..., "Merged"). The same features can
+be gathered from the single-diameter images without writing them, with
+Utils.dataset.VirtualMergedDataset("../Data/split/train"), or model_type "VirtualMerged" in the
+experiments config.
 """
 import glob
 import os
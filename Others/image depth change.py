@@ -1,33 +1,127 @@
 """
 This script is used to convert 16-bit depth images in the input folder to 8-bit depth images
  and save them in the output folder.
+
+The gray values of every image are stretched to 0-255 with its own minimum and maximum, through a
+lookup table of integers, so no float64 copy of the image is made. An image of a single gray value
+becomes black instead of dividing by zero. The images are converted by a pool of threads, and an
+image whose output is newer than itself is skipped. <output>_manifest.csv, next to the output
+folder so that the folder only holds the species, lists every source image with its output and the
+minimum and maximum the output was scaled from.
+
+With --features the histograms of the converted images are also written into the FeatureCache of
+the output folder, so read_img() on the output folder does not decode the images again.
+
+Usage:
+    python "Others/image depth change.py" [input] [output] [--workers 8] [--features]
 """
-import numpy as np
-import cv2
+import argparse
+import csv
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+FILE_ROOT = os.path.abspath(__file__).split("Others")[0]
+sys.path.append(FILE_ROOT)
+
+from Utils.cache import FeatureCache
+from Utils.features import batch_histograms
+from Utils.ingest import to_8bit
+from Utils.io import extract_features
+
+MANIFEST_COLUMNS = ["source", "output", "min", "max"]
+
 
+def output_name(inputFolder, origin):
+    """
+    The name of the output of an image: its path under the input folder joined by "_", without "untitled".
 
-def bit_depth_change(inputFolder, outputFolder):
+    e.g. Saccharomyces/13nm/4/batch1/untitled000.tif -> Saccharomyces_13nm_4_batch1_000.tif
+    """
+    parts = os.path.relpath(origin, inputFolder).split(os.sep)
+    return parts[0], "_".join(parts).replace("untitled", "")
+
+
+def manifest_path(outputFolder):
+    return f"{os.path.normpath(outputFolder)}_manifest.csv"
+
+
+def read_manifest(outputFolder):
+    path = manifest_path(outputFolder)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", newline="") as f:
+        return {row["source"]: row for row in csv.DictReader(f)}
+
+
+def bit_depth_change(inputFolder, outputFolder, workers=None, features=False, feature_num=225):
+    """
+    Convert the images under inputFolder to 8-bit, into one folder per species under outputFolder.
+
+    Args:
+        inputFolder: The folder of the 16-bit images, the first level of folders are the species.
+        outputFolder: The folder of the 8-bit images.
+        workers: The number of threads, the default is None, which uses all cores.
+        features: Whether to write the "Single" histograms of the outputs into the FeatureCache of
+         outputFolder, the default is False.
+        feature_num: The number of gray values (features) of the histograms, the default is 225.
+
+    Returns:
+        The rows of the manifest.
+    """
+    jobs = []
     for dirs, folders, files in os.walk(inputFolder):
-        for filename in files:
-            origin = os.path.join(dirs, filename)
-            # origin: .../bacteria\\Saccharomyces\\13nm\\4\\batch1\\untitled000.tif
-            img_16 = cv2.imread(origin, -1)
-            MAX, MIN = np.max(img_16), np.min(img_16)
-            img_16 = (img_16 - MIN) / (MAX - MIN) * 255
-            img_8 = img_16.astype(np.uint8)
+        for filename in sorted(files):
+            if filename.lower().endswith((".tif", ".tiff")):
+                origin = os.path.join(dirs, filename)
+                species, name = output_name(inputFolder, origin)
+                jobs.append((origin, os.path.join(outputFolder, species, name)))
+    for species in {os.path.dirname(output) for _, output in jobs}:
+        os.makedirs(species, exist_ok=True)
+    manifest = read_manifest(outputFolder)
+
+    def work(job):
+        origin, output = job
+        key = os.path.relpath(origin, inputFolder)
+        if key in manifest and os.path.exists(output) and os.path.getmtime(output) >= os.path.getmtime(origin):
+            return manifest[key], False, None
+        img_8, low, high = to_8bit(cv2.imread(origin, cv2.IMREAD_UNCHANGED))
+        cv2.imwrite(output, img_8)
+        hist = None
+        if features:
+            hist = batch_histograms(cv2.resize(img_8, (256, 256))[np.newaxis], "Single", feature_num)[0]
+        return {"source": key, "output": os.path.relpath(output, outputFolder), "min": low, "max": high}, True, hist
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        results = list(executor.map(work, jobs))
+    rows = [row for row, _, _ in results]
+    with open(manifest_path(outputFolder), "w", newline="") as f:
+        writer = csv.DictWriter(f, MANIFEST_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"{sum(converted for _, converted, _ in results)} of {len(rows)} images converted")
+
+    if features:
+        histograms = {output: hist for (_, output), (_, _, hist) in zip(jobs, results) if hist is not None}
 
-            species = origin.split("\\")[1]
-            sub_folder = os.path.join(outputFolder, species)
-            if not os.path.exists(sub_folder):
-                os.mkdir(sub_folder)
+        def extract(files):
+            # the images converted now are not decoded again
+            missing = [file for file in files if file not in histograms]
+            decoded = dict(zip(missing, extract_features(missing, "Single", feature_num, workers)))
+            return np.stack([histograms[file] if file in histograms else decoded[file] for file in files])
 
-            output = origin.split('bacteria\\')[-1].replace("\\", "_").replace("untitled", "")
-            output = os.path.join(sub_folder, output)
-            cv2.imwrite(output, img_8)
+        FeatureCache(outputFolder, "Single", feature_num).get([output for _, output in jobs], extract)
+    return rows
 
 
 if __name__ == '__main__':
-    inputFolder = "bacteria16"
-    outputFolder = "bacteria8"
-    bit_depth_change(inputFolder, outputFolder)
+    parser = argparse.ArgumentParser(description="Convert 16-bit images to 8-bit.")
+    parser.add_argument("input", nargs="?", default="bacteria16")
+    parser.add_argument("output", nargs="?", default="bacteria8")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--features", action="store_true")
+    args = parser.parse_args()
+    bit_depth_change(args.input, args.output, args.workers, args.features)
@@ -1,59 +1,34 @@
 """
 This script is used to split the dataset into two parts, the train set and the test set.
-"""
-import glob
-import os
-import random
-import shutil
 
+The split is written as a manifest (see Utils.splits), which lists the fold of every image of the
+dataset, instead of copying the images. The same seed gives the same split. The models read the
+folds from the dataset itself with Utils.splits.SplitDataset; --materialize also writes the train
+and test folders, with hard links to the images, for the scripts that read folders.
 
-def split(files, test_path, train_path, ratio):
-    """
-    split the files into two folders.
+Usage:
+    python "Others/split dataset.py" [root] [manifest] [--ratio 0.2] [--seed 0] [--materialize folder]
+"""
+import argparse
+import os
+import sys
 
-    Args:
-        files: list, the files to be split.
-        test_path: str, the folder to store the test set.
-        train_path: str, the folder to store the train set.
-        ratio: float, the ratio of the test set.
-    """
-    random.shuffle(files)
-    num = int(len(files) * ratio)
-    # copy to test folder
-    for file in files[:num]:
-        print(files.index(file))
-        new_path = os.path.join(test_path, os.path.basename(file))
-        shutil.copy(file, new_path)
-    # copy to train folder
-    for file in files[num:]:
-        print(files.index(file))
-        new_path = os.path.join(train_path, os.path.basename(file))
-        shutil.copy(file, new_path)
+FILE_ROOT = os.path.abspath(__file__).split("Others")[0]
+sys.path.append(FILE_ROOT)
 
+from Utils.splits import make_split, materialize
 
 if __name__ == '__main__':
-    concentrations = ('10^4', '10^5', '10^6')
-    diameter = ('5nm', '13nm', '60nm')
-
-    root = "../Data/image_RF(imageJ)"
-    train_folder = "d:/process2/split/train"
-    test_folder = "d:/process2/split/test"
-
-    folders = os.listdir(root)
-    for folder in folders:
-        sub_folder = os.path.join(root, folder)
-        test_sub_folder = os.path.join(test_folder, folder)
-        train_sub_folder = os.path.join(train_folder, folder)
-        os.makedirs(test_sub_folder, exist_ok=True)
-        os.makedirs(train_sub_folder, exist_ok=True)
-
-        if folder == "Blank":
-            for d in diameter:
-                files = glob.glob(f"{sub_folder}/*{d}*.tif")
-                split(files, test_sub_folder, train_sub_folder, 0.2)
-
-        else:
-            for c in concentrations:
-                for d in diameter:
-                    files = glob.glob(f"{sub_folder}/*{d}*{c}*.tif")
-                    split(files, test_sub_folder, train_sub_folder, 0.2)
+    parser = argparse.ArgumentParser(description="Split a dataset into a train and a test set.")
+    parser.add_argument("root", nargs="?", default="../Data/image_RF(imageJ)")
+    parser.add_argument("manifest", nargs="?", default="../Data/split.csv")
+    parser.add_argument("--ratio", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--materialize", default=None)
+    args = parser.parse_args()
+
+    manifest = make_split(args.root, args.ratio, args.seed)
+    manifest.to_csv(args.manifest, index=False)
+    print(manifest.groupby(["organism", "fold"]).size())
+    if args.materialize:
+        materialize(args.root, manifest, args.materialize)
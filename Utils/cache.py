@@ -0,0 +1,162 @@
+import hashlib
+import json
+import os
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+from Utils.features import FEATURE_VERSION
+
+CACHE_ROOT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".feature_cache")
+
+
+def default_cache_root():
+    """The folder of the shards: $FEATURE_CACHE_DIR, read when a cache is opened, or CACHE_ROOT."""
+    return os.environ.get("FEATURE_CACHE_DIR", CACHE_ROOT)
+
+
+@contextmanager
+def shard_lock(path):
+    """
+    Hold an exclusive lock on the file at path, so that one process at a time updates a shard.
+
+    The lock is an advisory lock on the whole file (fcntl on POSIX, msvcrt on Windows), released
+    when the block ends or the process dies.
+    """
+    with open(path, "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class FeatureCache:
+    """
+    Persistent on-disk cache of histogram features for the images under one dataset root.
+
+    Every dataset root gets its own shard directory inside default_cache_root(). For each combination of
+    model_type and feature_num the shard holds a "{model_type}_{feature_num}_v{FEATURE_VERSION}.rows"
+    file of raw feature rows, which is opened memory-mapped, and a .json index of the same name that
+    holds the dtype and number of rows of the matrix and maps the path of every image (relative to
+    the root) to its row together with the mtime and size the features were extracted from. A row is
+    only reused when mtime and size still match, so new or changed images are the only ones that
+    are decoded again.
+
+    The rows file is append-only: the rows of new or changed images are appended to it, and the
+    index, which is replaced atomically once the rows are written, is the only thing that points to
+    them. A reader therefore always sees an index and the rows it refers to, whatever the writers
+    do. Writers take the lock of the shard, so processes that build the same shard concurrently
+    decode every image once: the later ones find the rows the first one has written.
+
+    Args:
+        root: The dataset root that contains the images.
+        model_type: The form of data accepted by the model. It can be "Single" or "Merged".
+        feature_num: The number of gray values (features) for each gray histogram.
+        cache_root: The folder where the shards are stored, the default is None, which uses default_cache_root().
+    """
+
+    def __init__(self, root, model_type, feature_num, cache_root=None):
+        self.root = os.path.abspath(root)
+        digest = hashlib.sha1(self.root.encode("utf-8")).hexdigest()[:16]
+        shard = f"{os.path.basename(self.root.rstrip(os.sep))}_{digest}"
+        self.folder = os.path.join(cache_root or default_cache_root(), shard)
+        self.name = f"{model_type}_{feature_num}_v{FEATURE_VERSION}"
+        self.feature_path = os.path.join(self.folder, f"{self.name}.rows")
+        self.index_path = os.path.join(self.folder, f"{self.name}.json")
+        self.lock_path = os.path.join(self.folder, f"{self.name}.lock")
+
+    def _load(self):
+        """Load the index and the memory-mapped feature matrix, an inconsistent shard is treated as empty."""
+        if not (os.path.exists(self.index_path) and os.path.exists(self.feature_path)):
+            return {"files": {}, "shape": None, "dtype": None}, None
+        with open(self.index_path, "r") as f:
+            index = json.load(f)
+        n_rows, n_features = index["shape"]
+        dtype = np.dtype(index["dtype"])
+        if os.path.getsize(self.feature_path) < n_rows * n_features * dtype.itemsize:
+            return {"files": {}, "shape": None, "dtype": None}, None
+        if n_rows == 0:
+            return index, np.empty((0, n_features), dtype=dtype)
+        return index, np.memmap(self.feature_path, dtype=dtype, mode="r", shape=(n_rows, n_features))
+
+    def _missing(self, index, keys, stats):
+        """The positions of the images whose row is absent from the index or out of date."""
+        missing = []
+        for i, (key, stat) in enumerate(zip(keys, stats)):
+            entry = index["files"].get(key)
+            if entry is None or entry[1:] != [stat.st_mtime_ns, stat.st_size]:
+                missing.append(i)
+        return missing
+
+    def _append(self, index, keys, stats, missing, new):
+        """Append the rows of the missing images to the rows file and replace the index."""
+        new = np.ascontiguousarray(new)
+        if index["shape"] is None:
+            # an empty or inconsistent shard starts again from an empty rows file
+            index = {"files": {}, "shape": [0, new.shape[1]], "dtype": new.dtype.str}
+            open(self.feature_path, "wb").close()
+        new = np.ascontiguousarray(new.astype(np.dtype(index["dtype"]), copy=False))
+        n_rows = index["shape"][0]
+        with open(self.feature_path, "r+b") as f:
+            # rows past the index are the leftovers of an interrupted writer, they are overwritten
+            f.seek(n_rows * new.shape[1] * new.dtype.itemsize)
+            f.write(new.tobytes())
+            f.truncate()
+            f.flush()
+            os.fsync(f.fileno())
+        for j, i in enumerate(missing):
+            index["files"][keys[i]] = [n_rows + j, stats[i].st_mtime_ns, stats[i].st_size]
+        index["shape"] = [n_rows + len(new), new.shape[1]]
+        tmp = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp, self.index_path)
+
+    def get(self, files, extract):
+        """
+        Return the features of the given images, extracting and storing only the missing ones.
+
+        Args:
+            files: The paths of the images, they must be located under the root of the cache.
+            extract: A function that maps a list of image paths to a 2D array of their features.
+
+        Returns:
+            A ndarray whose i-th row is the feature vector of files[i].
+        """
+        keys = [os.path.relpath(os.path.abspath(file), self.root) for file in files]
+        stats = [os.stat(file) for file in files]
+        index, features = self._load()
+        if self._missing(index, keys, stats):
+            os.makedirs(self.folder, exist_ok=True)
+            with shard_lock(self.lock_path):
+                # another process may have added the rows while this one waited for the lock
+                index, features = self._load()
+                missing = self._missing(index, keys, stats)
+                if missing:
+                    self._append(index, keys, stats, missing, extract([files[i] for i in missing]))
+                    index, features = self._load()
+
+        if features is None:
+            return np.empty((0, 0))
+        rows = np.fromiter((index["files"][key][0] for key in keys), dtype=np.intp, count=len(keys))
+        return np.asarray(features[rows])
@@ -0,0 +1,200 @@
+import glob
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+from Utils.features import FEATURE_DTYPES
+from Utils.ingest import DIAMETERS, pairing
+from Utils.io import list_img, read_img, shared_array
+from Utils.names import BLANK, CONCENTRATIONS
+
+DIAMETER_PATTERN = re.compile(r"(\d+nm)")
+CONCENTRATION_PATTERN = re.compile(r"(10\^\d+)")
+BATCH_PATTERN = re.compile(r"batch(\d+)")
+
+
+def parse_filename(file):
+    """
+    Extract the diameter, concentration and batch number from the name of an image.
+
+    Args:
+        file: The path of the image, e.g. ".../E.coli/E.coli_13nm_10^4_batch1_000.tif".
+
+    Returns:
+        A tuple (diameter, concentration, batch), the fields that are not in the name are None.
+    """
+    name = os.path.basename(file)
+    fields = []
+    for pattern in (DIAMETER_PATTERN, CONCENTRATION_PATTERN, BATCH_PATTERN):
+        match = pattern.search(name)
+        fields.append(match.group(1) if match else None)
+    if fields[2] is not None:
+        fields[2] = int(fields[2])
+    return tuple(fields)
+
+
+class Dataset:
+    """
+    All the images under one dataset root, read once and kept as a single feature matrix.
+
+    The histograms of every image are stored in one C-contiguous matrix X, and the metadata of the
+    images (file, organism, diameter, concentration, batch) is kept row by row in the DataFrame meta.
+    The per-concentration data that read_img used to produce with one pass over the folder each is
+    derived from them by boolean-mask indexing.
+
+    Args:
+        path: the path of folder that contains the images
+        model_type: The form of data accepted by the model. It can be "Single" or "Merged".
+        feature_num: The number of gray values (features) for each gray histogram, the default is 225.
+        cache: Whether to reuse the histograms stored by FeatureCache, the default is True.
+        workers: The number of threads used to decode the images, the default is None.
+        dtype: The dtype the histograms are stored in, see compact_features(). The default is None.
+    """
+
+    def __init__(self, path, model_type, feature_num=225, cache=True, workers=None, dtype=None):
+        self.path = path
+        self.model_type = model_type
+        self.feature_num = feature_num
+        self.organisms = os.listdir(path)
+
+        self.X, y = read_img(path, model_type, "all", feature_num, cache, workers, dtype)
+        files, _ = list_img(path, "all")
+        diameters, concentrations, batches = zip(*map(parse_filename, files)) if files else ((), (), ())
+        self.meta = pd.DataFrame({
+            "file": files,
+            "organism": [self.organisms[i] for i in y],
+            "diameter": diameters,
+            "concentration": concentrations,
+            "batch": batches,
+        })
+
+    def __len__(self):
+        return len(self.meta)
+
+    def mask(self, concentration="all"):
+        """
+        Select the images read_img would read for the given concentration.
+
+        Args:
+            concentration: the concentration of the images, default is "all"
+
+        Returns:
+            A boolean ndarray with one entry per image.
+        """
+        if concentration == "all":
+            return np.ones(len(self), dtype=bool)
+        return ((self.meta["organism"] != BLANK) & (self.meta["concentration"] == concentration)).to_numpy()
+
+    def subset(self, concentration="all", share=False):
+        """
+        Return the histograms and labels of one concentration, labelled the same way as read_img.
+
+        Args:
+            concentration: the concentration of the images, default is "all"
+            share: Whether to return the histograms memory-mapped in shared memory, for the
+             workers of a cross validation, see shared_array(). The default is False.
+
+        Returns:
+            images: a ndarray of the histogram of the images
+            labels: a ndarray of the labels of the images
+        """
+        mask = self.mask(concentration)
+        organisms = self.organisms if concentration == "all" else [x for x in self.organisms if x != BLANK]
+        codes = {organism: index for index, organism in enumerate(organisms)}
+        labels = self.meta.loc[mask, "organism"].map(codes).to_numpy(dtype=int)
+        X = self.rows(mask)
+        return shared_array(X) if share else X, labels
+
+    def rows(self, mask):
+        """The histograms of the images selected by mask."""
+        return self.X[mask]
+
+    def sources(self, mask):
+        """The image files the rows selected by mask are read from, a tuple per row."""
+        return [(file,) for file in self.meta["file"][mask]]
+
+
+def merge_triples(path, files):
+    """
+    The rows of the 5nm, 13nm and 60nm images of every image "Merge three pictures.py" would write.
+
+    Within one organism and one concentration (all the images of a Blank organism), the n-th 5nm
+    image is merged with the 13nm and 60nm images of the same rank, three times, with the 13nm
+    images rotated by one third and the 60nm images by two thirds of the list, see pairing().
+
+    Args:
+        path: The folder of the single-diameter images, one folder per organism.
+        files: The images under path, in the order of the rows of their histograms.
+
+    Returns:
+        triples: A ndarray of shape (n_merged, 3) with the rows of the three images of every merged image.
+        names: The paths the merged images would have, "<organism>/<concentration>_<k>.tif".
+    """
+    rows = {os.path.abspath(file): i for i, file in enumerate(files)}
+    triples, names = [], []
+    for organism in os.listdir(path):
+        folder = os.path.join(path, organism)
+        blank = organism in (BLANK, "Blank")
+        for concentration in ["blank"] if blank else CONCENTRATIONS[:-1]:
+            pattern = "*{}*.tif" if blank else f"*{{}}*{concentration}*.tif"
+            group = [sorted(glob.glob(os.path.join(folder, pattern.format(d)))) for d in DIAMETERS]
+            num = min(len(images) for images in group)
+            for k, rank in enumerate(pairing(num)):
+                triples.append([rows[os.path.abspath(group[d][r])] for d, r in enumerate(rank)])
+                names.append(os.path.join(folder, f"{concentration}_{k}.tif"))
+    return np.array(triples, dtype=np.intp).reshape(-1, 3), names
+
+
+class VirtualMergedDataset(Dataset):
+    """
+    The "Merged" dataset of the images "Merge three pictures.py" would write from the single-diameter
+    images under path, without writing them.
+
+    The histogram of a channel only depends on that channel, so the "Merged" vector of a merged
+    image is the histograms of its 5nm, 13nm and 60nm images one after another. The single
+    histograms of the images under path are read once (through the FeatureCache), and the merged
+    vectors are gathered from them by the index triples of merge_triples(), the same vectors
+    Dataset(<three_channel_combine>, "Merged") reads from the merged TIFFs. subset() only gathers
+    the rows it returns, X gathers all of them.
+
+    Args:
+        path: The folder of the single-diameter images, e.g. Data/split/train.
+        feature_num: The number of gray values (features) for each gray histogram, the default is 225.
+        cache: Whether to reuse the histograms stored by FeatureCache, the default is True.
+        workers: The number of threads used to decode the images, the default is None.
+    """
+
+    def __init__(self, path, feature_num=225, cache=True, workers=None):
+        self.path = path
+        self.model_type = "Merged"
+        self.feature_num = feature_num
+        self.organisms = os.listdir(path)
+
+        files, _ = list_img(path, "all")
+        self.single_files = files
+        self.singles, _ = read_img(path, "Single", "all", feature_num, cache, workers, FEATURE_DTYPES["Merged"])
+        self.triples, names = merge_triples(path, files)
+        organisms = [os.path.basename(os.path.dirname(name)) for name in names]
+        concentrations = [os.path.basename(name).split("_")[0] for name in names]
+        self.meta = pd.DataFrame({
+            "file": names,
+            "organism": organisms,
+            "diameter": None,
+            "concentration": [None if c == "blank" else c for c in concentrations],
+            "batch": None,
+        })
+
+    @property
+    def X(self):
+        return self.rows(slice(None))
+
+    def rows(self, mask):
+        """The merged vectors of the images selected by mask, gathered from the single histograms."""
+        triples = self.triples[mask]
+        return self.singles[triples].reshape(len(triples), 3 * self.feature_num)
+
+    def sources(self, mask):
+        """The 5nm, 13nm and 60nm images the merged images selected by mask are gathered from."""
+        return [tuple(self.single_files[i] for i in triple) for triple in self.triples[mask]]
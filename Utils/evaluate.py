@@ -1,5 +1,11 @@
-from sklearn.metrics import accuracy_score, recall_score, f1_score, precision_score
-from sklearn.model_selection import cross_val_score
+import numpy as np
+from joblib import Parallel, delayed
+from sklearn.base import clone
+from sklearn.metrics import (accuracy_score, recall_score, f1_score, precision_score, roc_auc_score,
+                             average_precision_score)
+from sklearn.model_selection import StratifiedKFold
+
+from Utils.io import shared
 
 
 def model_metrics(y_test, y_pred):
@@ -28,3 +34,79 @@ def model_metrics(y_test, y_pred):
     print('\n')
 
     return accuracy, recall, f1score, precision
+
+
+def fit_fold(model, X, y, train, test):
+    """
+    Fit a copy of the model on one training fold and keep its predictions on the test fold.
+
+    Args:
+        model: The unfitted model or pipeline.
+        X: Features of the data.
+        y: Real label of data.
+        train: The indices of the training fold.
+        test: The indices of the test fold.
+
+    Returns:
+        test: The indices of the test fold.
+        y_pred: The labels predicted for the test fold.
+        y_proba: The probabilities predicted for the test fold, None if the model has no predict_proba.
+        y_score: The scores used for the ranking metrics. They come from decision_function if the
+         model has one, otherwise from predict_proba, as the "roc_auc" scorer of sklearn does.
+    """
+    model = clone(model).fit(X[train], y[train])
+    y_pred = model.predict(X[test])
+    y_proba = model.predict_proba(X[test]) if hasattr(model, "predict_proba") else None
+    if hasattr(model, "decision_function"):
+        y_score = model.decision_function(X[test])
+    else:
+        y_score = y_proba[:, 1] if y_proba.shape[1] == 2 else y_proba
+    return test, y_pred, y_proba, y_score
+
+
+def cv_splits(y, n_splits=30):
+    """The (train, test) indices of the folds of StratifiedKFold(n_splits), as used by cross_val_score."""
+    return list(StratifiedKFold(n_splits=n_splits).split(np.zeros(len(y)), y))
+
+
+def cross_validation(model, X, y, scoring=("accuracy",), n_splits=30, n_jobs=-1, splits=None):
+    """
+    Evaluate the model with stratified k-fold cross validation, fitting every fold only once and
+    computing all the requested metrics from the kept fold predictions. This replaces one
+    cross_val_score() call per metric, which refits the model on every fold for every metric.
+
+    Args:
+        model: The unfitted model or pipeline.
+        X: Features of the data.
+        y: Real label of data.
+        scoring: The metrics to compute, any of "accuracy", "roc_auc" and "average_precision".
+        n_splits: The number of folds of StratifiedKFold, the default is 30.
+        n_jobs: The number of folds fitted in parallel, the default is -1 (all cores).
+        splits: The (train, test) indices of the folds, e.g. computed once by cv_splits() and
+         shared between models. The default is None, which splits with StratifiedKFold(n_splits).
+         With n_jobs != 1, X is memory-mapped by shared() while the folds are fitted, so the
+         workers only receive the indices of their fold.
+
+    Returns:
+        scores: A dict that maps every metric to the list of its scores on the folds.
+        folds: A list of (test, y_pred, y_proba, y_score) tuples, one per fold, see fit_fold().
+    """
+    metrics = {
+        "accuracy": lambda y_true, y_pred, y_score: accuracy_score(y_true, y_pred),
+        "roc_auc": lambda y_true, y_pred, y_score: roc_auc_score(y_true, y_score),
+        "average_precision": lambda y_true, y_pred, y_score: average_precision_score(y_true, y_score),
+    }
+    if splits is None:
+        splits = cv_splits(y, n_splits)
+    if n_jobs == 1:
+        folds = [fit_fold(model, X, y, train, test) for train, test in splits]
+    else:
+        with shared(X) as X_shared:
+            folds = Parallel(n_jobs=n_jobs)(delayed(fit_fold)(model, X_shared, y, train, test)
+                                            for train, test in splits)
+
+    scores = {metric: [] for metric in scoring}
+    for test, y_pred, y_proba, y_score in folds:
+        for metric in scoring:
+            scores[metric].append(metrics[metric](y[test], y_pred, y_score))
+    return scores, folds
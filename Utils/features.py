@@ -0,0 +1,162 @@
+"""
+Extraction of the gray histogram features.
+
+Binning definition: the images are 8-bit, and every gray value v in 0-255 is counted in its own
+bin v, which is the range [0, 256] with 256 bins in cv2.calcHist. The feature vector of a channel
+is the first feature_num bins (0-224 with the default threshold of 225). "Single" images give the
+histogram of their only channel, "Merged" images the histograms of channels 0, 1, 2 (5nm, 13nm,
+60nm) one after another.
+
+trans_to_single_glh() and trans_to_merged_glh() are the reference implementation, one image at a
+time through cv2.calcHist. Every faster path (batch_histograms(), the parallel and cached read_img)
+must give the same output, which is checked by tests/test_features.py.
+
+Storage dtype: a 256x256 image has 65536 pixels, so a bin fits in uint16 (0-65535) unless all the
+pixels of a channel share one gray value. Features stored in an integer dtype are therefore
+saturated at the largest value of the dtype instead of wrapping around, which only affects such
+constant channels. By default "Single" features are float32 (the dtype of cv2.calcHist, kept so
+that the models see the same input as before) and "Merged" features are uint16; see FEATURE_DTYPES
+and compact_features().
+"""
+import cv2
+import numpy as np
+
+GRAY_LEVELS = 256
+HIST_RANGE = [0, GRAY_LEVELS]
+FEATURE_VERSION = 3
+FEATURE_DTYPES = {"Single": np.float32, "Merged": np.uint16}
+
+
+def saturate(features, dtype):
+    """
+    Cast features to dtype, integer dtypes are saturated at their largest value instead of wrapping.
+
+    Args:
+        features: A ndarray of histogram counts.
+        dtype: The target dtype.
+
+    Returns:
+        A ndarray of the given dtype.
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind in "ui":
+        features = np.minimum(features, np.iinfo(dtype).max)
+    return features.astype(dtype, copy=False)
+
+
+def compact_features(features, dtype=None, sparse=False):
+    """
+    Store a feature matrix in a compact dtype and a C-contiguous layout.
+
+    Args:
+        features: A 2D ndarray of histogram counts.
+        dtype: The storage dtype, e.g. np.uint16, np.uint32 or np.float32. None keeps the dtype.
+        sparse: If True, return a scipy.sparse.csr_matrix, which only stores the non-zero bins. The
+          high gray values are empty in most images, so this is smaller for feature_num=256.
+          RandomForestClassifier accepts it directly, PCA and KernelPCA need a dense matrix.
+
+    Returns:
+        A C-contiguous ndarray, or a csr_matrix if sparse is True.
+    """
+    if dtype is not None:
+        features = saturate(np.asarray(features), dtype)
+    features = np.ascontiguousarray(features)
+    if sparse:
+        from scipy.sparse import csr_matrix
+        return csr_matrix(features)
+    return features
+
+
+def trans_to_single_glh(img, feature_num=225):
+    """
+    It is used to extract the grayscale histogram of the image and intercept the grayscale range
+    of 0-225 as a one-dimensional vector output.
+
+    Args:
+        img: Input image.
+        feature_num: The number of gray values (features) for each gray histogram. The value of a
+         grayscale histogram without threshold restriction is 256, and that of a grayscale histogram
+          with threshold restriction is 225. The default value is 225.
+
+    Returns:
+        A one-dimensional vector of a grayscale histogram with grayscale values in the range 0-225.
+    """
+
+    hist = cv2.calcHist([img], [0], None, [GRAY_LEVELS], HIST_RANGE)
+    hist = hist[:feature_num, ]
+    return hist.ravel()
+
+
+def trans_to_merged_glh(img, feature_num=225):
+    """
+    It is used to extract the gray histogram of the three-channel image (each channel stores an
+    AuNPs gray image), and intercepts the range of gray value 0-225 as a one-dimensional vector,
+    and finally splits the three one-dimensional vectors into a one-dimensional vector according
+    to the order of "AuNPs1, AuNPs2, AuNPs3".
+
+    Args:
+        img: Input three channel picture.
+        feature_num: The number of gray values (features) for each gray histogram. The value of a
+         grayscale histogram without threshold restriction is 256, and that of a grayscale histogram
+          with threshold restriction is 225. The default value is 225.
+
+    Returns:
+        A one-dimensional vector composed of three one-dimensional vectors.
+    """
+
+    hist_list = []
+    for i in range(3):
+        hist = cv2.calcHist([img], [i], None, [GRAY_LEVELS], HIST_RANGE)
+        hist_new = hist[:feature_num, ]
+        hist_list.append(saturate(hist_new.ravel(), np.uint16))
+    return np.hstack(hist_list)
+
+
+def batch_histograms(images, model_type, feature_num=225, out=None, chunk_size=16, dtype=None):
+    """
+    Calculate the gray histograms of a stack of images in one vectorized pass.
+
+    Every pixel value v of channel c of image n is shifted to the bin (n * C + c) * 256 + v, so a
+    single np.bincount over the chunk produces all the per-channel histograms at once. The first
+    feature_num bins of every channel are then written into out in the layout of
+    trans_to_single_glh ("Single", channel 0 only) or trans_to_merged_glh ("Merged", the histograms
+    of channels 0, 1, 2 one after another). Images of any other dtype than uint8 raise a ValueError,
+    their values would be counted in the bins of another channel or image.
+
+    Args:
+        images: A uint8 ndarray of shape (N, 256, 256) or (N, 256, 256, C).
+        model_type: The form of data accepted by the model. It can be "Single" or "Merged".
+        feature_num: The number of gray values (features) for each gray histogram, the default is 225.
+        out: The array the histograms are written into, a new one is allocated if it is None.
+        chunk_size: The number of images counted by one np.bincount call, which bounds the size of
+          the temporary index array. The default is 16.
+        dtype: The dtype of a newly allocated out, the default is FEATURE_DTYPES[model_type]. Integer
+          dtypes are saturated.
+
+    Returns:
+        A ndarray of shape (N, feature_num) for "Single" or (N, 3 * feature_num) for "Merged".
+    """
+    images = np.asarray(images)
+    if images.dtype != np.uint8:
+        raise ValueError(f"batch_histograms() counts uint8 images, not {images.dtype}, see Utils.ingest.to_8bit()")
+    if images.ndim == 3:
+        images = images[..., np.newaxis]
+    images = images[..., :1] if model_type == "Single" else images[..., :3]
+    n, channels = len(images), images.shape[-1]
+    if out is None:
+        out = np.empty((n, channels * feature_num), dtype=dtype or FEATURE_DTYPES[model_type])
+    if out.dtype.kind in "ui":
+        limit = np.iinfo(out.dtype).max
+
+    offsets = np.arange(channels, dtype=np.intp) * GRAY_LEVELS
+    for start in range(0, n, chunk_size):
+        chunk = images[start:start + chunk_size]
+        m = len(chunk)
+        chunk = chunk.reshape(m, -1, channels)
+        index = chunk + (offsets + np.arange(m, dtype=np.intp)[:, np.newaxis, np.newaxis] * channels * GRAY_LEVELS)
+        hist = np.bincount(index.ravel(), minlength=m * channels * GRAY_LEVELS)
+        hist = hist.reshape(m, channels, GRAY_LEVELS)
+        if out.dtype.kind in "ui":
+            np.minimum(hist, limit, out=hist)
+        out[start:start + m] = hist[..., :feature_num].reshape(m, channels * feature_num)
+    return out
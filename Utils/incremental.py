@@ -0,0 +1,250 @@
+"""
+Incremental updates of the trained models when a new acquisition batch of images arrives.
+
+Instead of retraining every model on the whole dataset, update() only refreshes the models of
+Utils.runner whose training data gained images, and reuses what was already fitted:
+
+* RandomForest: trees grown on the new images are added to the forest with warm_start, in
+  proportion to the share of the new images in the training data.
+* PCA/KernelPCA -> LDA: the models are refitted from LinearStats, the per-class counts, means and
+  scatter matrices of all the images seen so far, which are updated with the new images only.
+  The decomposition is solved from the pooled covariance and the LDA with the eigen solver, so a
+  KernelPCA(kernel="linear") model comes back as the equivalent PCA.
+
+The images a model has seen are recorded next to it. For a model without that record, the images
+older than the model file are taken as seen. The merged images of VirtualMergedDataset and of the
+merged folds of SplitDataset only exist as a pairing of single images, which changes when images
+are added, so their single images are recorded instead, and a merged image is new when one of its
+single images is. With --drift every refreshed model is also retrained
+from scratch, and the accuracy of both on the test data is written to table/<identifier>_drift.xlsx.
+
+Usage:
+    python -m Utils.incremental [config] [--only RF/nine_merged ...] [--drift]
+"""
+import argparse
+import json
+import math
+import os
+import pickle
+
+import numpy as np
+from scipy import linalg
+from sklearn.decomposition import PCA
+from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
+from sklearn.metrics import accuracy_score
+from sklearn.pipeline import Pipeline
+
+from Utils.io import save_model, insert_into_table, export_tables
+from Utils.model_store import linear_path, store_path
+from Utils.predict import LinearPipeline
+from Utils.runner import CONFIG, build_estimator, plan
+from Utils.scheduler import load_dataset
+
+DRIFT_COLUMNS = ["name", "concentration", "new_images", "accuracy_incremental", "accuracy_retrain", "drift"]
+
+
+class LinearStats:
+    """
+    The sufficient statistics of PCA and LDA: the number of samples, the mean and the scatter matrix
+    (sum of the outer products of the centred samples) of every class. Batches are merged with the
+    pairwise update of Chan et al., so the statistics of all the images equal those of one pass.
+
+    Args:
+        classes: The labels of the classes.
+        n_features: The number of features.
+    """
+
+    def __init__(self, classes, n_features):
+        self.classes = np.asarray(classes)
+        self.counts = np.zeros(len(classes))
+        self.means = np.zeros((len(classes), n_features))
+        self.scatters = np.zeros((len(classes), n_features, n_features))
+
+    def update(self, X, y):
+        """Merge the samples X with labels y into the statistics."""
+        X = np.asarray(X, dtype=np.float64)
+        for k, label in enumerate(self.classes):
+            X_k = X[y == label]
+            if not len(X_k):
+                continue
+            n_a, n_b = self.counts[k], len(X_k)
+            mean_b = X_k.mean(axis=0)
+            centred = X_k - mean_b
+            delta = mean_b - self.means[k]
+            n = n_a + n_b
+            self.means[k] += delta * n_b / n
+            self.scatters[k] += centred.T @ centred + np.outer(delta, delta) * n_a * n_b / n
+            self.counts[k] = n
+        return self
+
+    def total(self):
+        """The number of samples, the mean and the scatter matrix of all the classes together."""
+        n = self.counts.sum()
+        mean = self.counts @ self.means / n
+        delta = self.means - mean
+        return n, mean, self.scatters.sum(axis=0) + (delta.T * self.counts) @ delta
+
+    def fit_pca_lda(self, pca_params, lda_params):
+        """
+        Build the fitted PCA -> LDA pipeline of the statistics, as PCA(svd_solver="full") and
+        LinearDiscriminantAnalysis(solver="eigen") fitted on the samples would be.
+
+        Args:
+            pca_params: The parameters of the PCA/KernelPCA, only n_components and whiten are used.
+            lda_params: The parameters of the LDA, the solver is replaced by "eigen".
+
+        Returns:
+            The fitted Pipeline.
+        """
+        n, mean, scatter = self.total()
+        evals, evecs = linalg.eigh(scatter / (n - 1))
+        evals, evecs = evals[::-1], evecs[:, ::-1]
+        k = pca_params["n_components"]
+        pca = PCA(n_components=k, whiten=pca_params.get("whiten", False), svd_solver="full")
+        pca.mean_ = mean
+        pca.components_ = evecs[:, :k].T
+        pca.explained_variance_ = evals[:k]
+        pca.explained_variance_ratio_ = evals[:k] / evals.sum()
+        pca.singular_values_ = np.sqrt(np.maximum(evals[:k], 0) * (n - 1))
+        pca.noise_variance_ = evals[k:].mean() if k < len(evals) else 0.0
+        pca.n_components_ = k
+        pca.n_samples_ = int(n)
+        pca.n_features_in_ = len(mean)
+
+        # the statistics of the projected samples
+        P = pca.components_.T
+        if pca.whiten:
+            P = P / np.sqrt(pca.explained_variance_)
+        means = (self.means - mean) @ P
+        priors = self.counts / n
+        Sw = sum(prior * P.T @ (scatter_k / count) @ P
+                 for prior, scatter_k, count in zip(priors, self.scatters, self.counts))
+        St = P.T @ (scatter / n) @ P
+
+        lda = LinearDiscriminantAnalysis(**dict(lda_params, solver="eigen"))
+        lda.classes_ = self.classes
+        lda.priors_ = priors if lda.priors is None else np.asarray(lda.priors)
+        lda.means_ = means
+        lda.covariance_ = Sw
+        lda._max_components = lda.n_components or min(len(self.classes) - 1, k)
+        evals, evecs = linalg.eigh(St - Sw, Sw)
+        lda.explained_variance_ratio_ = np.sort(evals / np.sum(evals))[::-1][:lda._max_components]
+        evecs = evecs[:, np.argsort(evals)[::-1]]
+        lda.scalings_ = evecs
+        lda.coef_ = means @ evecs @ evecs.T
+        lda.intercept_ = -0.5 * np.diag(means @ lda.coef_.T) + np.log(lda.priors_)
+        if len(self.classes) == 2:
+            lda.coef_ = (lda.coef_[1] - lda.coef_[0]).reshape(1, -1)
+            lda.intercept_ = np.array([lda.intercept_[1] - lda.intercept_[0]])
+        lda.n_features_in_ = k
+        lda._n_features_out = lda._max_components
+        return Pipeline([("pca", pca), ("lda", lda)])
+
+    def save(self, path):
+        np.savez(path, classes=self.classes, counts=self.counts, means=self.means, scatters=self.scatters)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        stats = cls(data["classes"], data["means"].shape[1])
+        stats.counts, stats.means, stats.scatters = data["counts"], data["means"], data["scatters"]
+        return stats
+
+
+def add_trees(model, X_new, y_new, X_all, y_all):
+    """
+    Add trees grown on the new samples to a fitted RandomForest with warm_start.
+
+    The number of new trees is the share of the new samples times n_estimators. The new trees are
+    grown on the whole training data when the new samples lack some of the classes, because the
+    forest needs every class in every fit.
+    """
+    n_new = max(1, math.ceil(model.n_estimators * len(y_new) / max(1, len(y_all) - len(y_new))))
+    X, y = (X_new, y_new) if set(np.unique(y_new)) == set(model.classes_) else (X_all, y_all)
+    model.set_params(warm_start=True, n_estimators=model.n_estimators + n_new).fit(X, y)
+    return model.set_params(warm_start=False)
+
+
+def seen_path(model_path):
+    return os.path.splitext(model_path)[0] + ".seen.json"
+
+
+def seen_files(model_path, files):
+    """The images the model at model_path has been trained on."""
+    if os.path.exists(seen_path(model_path)):
+        with open(seen_path(model_path), "r") as f:
+            return set(json.load(f))
+    trained = os.path.getmtime(model_path)
+    return {file for file in files if os.path.getmtime(file) <= trained}
+
+
+def update(experiment, drift=False):
+    """
+    Refresh the model of an experiment with the images it has not seen yet.
+
+    Args:
+        experiment: An Experiment of Utils.runner, whose model has been trained.
+        drift: Whether to retrain the model from scratch as well and report the accuracy of both.
+
+    Returns:
+        The number of new images, 0 if the model was not affected.
+    """
+    train_set = load_dataset(*experiment.dataset_args("train"))
+    mask = train_set.mask(experiment.concentration)
+    sources = [[os.path.abspath(file) for file in row] for row in train_set.sources(mask)]
+    files = sorted({file for row in sources for file in row})
+    X_all, y_all = train_set.subset(experiment.concentration)
+    model_path = experiment.path("model", f"{experiment.name}.pkl")
+    seen = seen_files(model_path, files)
+    new = np.array([any(file not in seen for file in row) for row in sources], dtype=bool)
+    if not new.any():
+        return 0
+    print(f"{experiment.name}: {new.sum()} new images")
+
+    # the .pkl holds the full model, the array store and the collapsed copy next to it are derived from it
+    with open(model_path, "rb") as f:
+        model = pickle.load(f)
+    stats_path = os.path.splitext(model_path)[0] + ".stats.npz"
+    if experiment.spec["estimator"] == "random_forest":
+        model = add_trees(model, X_all[new], y_all[new], X_all, y_all)
+    else:
+        if os.path.exists(stats_path):
+            stats = LinearStats.load(stats_path)
+        else:
+            stats = LinearStats(model.classes_, X_all.shape[1]).update(X_all[~new], y_all[~new])
+        stats.update(X_all[new], y_all[new])
+        model = stats.fit_pca_lda(model.steps[0][1].get_params(), model.steps[-1][1].get_params())
+        stats.save(stats_path)
+    # save_model() removes the copies of the old model, they are written again for the new one
+    had_store, had_linear = os.path.isdir(store_path(model_path)), os.path.isdir(linear_path(model_path))
+    save_model(model, model_path)
+    if had_store:
+        save_model(model, store_path(model_path))
+    if had_linear:
+        save_model(LinearPipeline.from_pipeline(model), linear_path(model_path))
+    with open(seen_path(model_path), "w") as f:
+        json.dump(files, f)
+
+    if drift:
+        X_test, y_test = load_dataset(*experiment.dataset_args("test")).subset(experiment.concentration)
+        retrain, _ = build_estimator(experiment.spec["estimator"], experiment.param_path())
+        retrain.fit(X_all, y_all)
+        accuracy = accuracy_score(y_test, model.predict(X_test))
+        accuracy_retrain = accuracy_score(y_test, retrain.predict(X_test))
+        insert_into_table([experiment.name, experiment.concentration, int(new.sum()), accuracy, accuracy_retrain,
+                           accuracy - accuracy_retrain], experiment.table("{identifier}_drift.xlsx"), DRIFT_COLUMNS)
+    return int(new.sum())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Update the trained models with the images they have not seen.")
+    parser.add_argument("config", nargs="?", default=CONFIG)
+    parser.add_argument("--only", nargs="*", default=None)
+    parser.add_argument("--drift", action="store_true")
+    args = parser.parse_args()
+    with open(args.config, "r") as f:
+        config = json.load(f)
+    for experiment in plan(config, args.only):
+        if experiment.trained:
+            update(experiment, args.drift)
+    export_tables()
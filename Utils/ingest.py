@@ -0,0 +1,224 @@
+"""
+Single-pass ingest of raw 16-bit acquisitions into merged histogram features.
+
+The preprocessing scripts of Others go through the images three times: "image depth change.py"
+writes 8-bit TIFFs, "Merge three pictures.py" reads them back, resizes them and merges three
+diameters into one 3-channel TIFF, and read_img() reads and resizes the merged TIFFs before
+counting their histograms. ingest() reads every raw image once: it is converted to 8-bit, resized
+to 256x256 and its histogram is counted right away. The histogram of a channel only depends on
+that channel, so the "Merged" vector of a merged image is the three histograms of its 5nm, 13nm and
+60nm images one after another, and the merged vectors are gathered from the single histograms
+without building the merged images.
+
+The images are paired as "Merge three pictures.py" pairs them: within one species and one
+concentration, the n-th 5nm image is merged with the 13nm and 60nm images of the same rank, and
+this is repeated three times with the 13nm images rotated by one third and the 60nm images by two
+thirds of the list. The images without a concentration (Blank) form one group named "blank".
+
+A merged image is made of three different images, so pairing the whole tree and splitting the
+merged images afterwards puts the same raw image into the train and the test fold. Given a split
+manifest of the raw images (see Utils.splits.split_raw()), every group is split by fold first and
+the images are paired within their fold only.
+
+The groups are processed one after another, the images of a group by a pool of threads, so the
+memory holds the histograms and, only when the merged TIFFs are written, the 8-bit images of one
+group. The output is <output>_Merged_<feature_num>.npy with the merged vectors and a .csv of the
+same name that lists, row by row, the fold (empty without a manifest), the organism, the
+concentration, the name of the merged image and its three source images. With --tiff the merged
+TIFFs are written under <output>/<organism>/, or <output>/<fold>/<organism>/ with a manifest, as
+well, and their histograms are stored in the FeatureCache, so read_img() on these folders does not
+decode them again.
+
+Usage:
+    python -m Utils.ingest input output [--feature_num 225] [--workers 8] [--tiff]
+                                        [--split manifest.csv | --ratio 0.2 [--seed 0]]
+"""
+import argparse
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import pandas as pd
+
+from Utils.cache import FeatureCache
+from Utils.features import FEATURE_DTYPES, batch_histograms
+
+DIAMETERS = ("5nm", "13nm", "60nm")
+BATCH_PATTERN = re.compile(r"^batch\d+$")
+
+
+def to_8bit(img):
+    """
+    Stretch the gray values of an image to 0-255, as (img - min) / (max - min) * 255 truncated to
+    uint8, computed exactly with integers.
+
+    Args:
+        img: An image of an unsigned integer dtype of at most 16 bits.
+
+    Returns:
+        img_8: The uint8 image, all 0 if the image has a single gray value.
+        low: The minimum of the image.
+        high: The maximum of the image.
+    """
+    low, high = int(img.min()), int(img.max())
+    lut = np.zeros(np.iinfo(img.dtype).max + 1, dtype=np.uint8)
+    if high > low:
+        lut[low:high + 1] = np.arange(high - low + 1, dtype=np.uint32) * 255 // (high - low)
+    return lut[img], low, high
+
+
+def scan(root):
+    """
+    Group the raw images under root by organism, concentration and diameter.
+
+    The first folder under root is the organism. Of the other folders, the one named like a
+    diameter (e.g. 13nm) is the diameter, batch folders are ignored and the remaining one is the
+    concentration, "blank" if there is none.
+
+    Returns:
+        A dict {(organism, concentration): {diameter: [files]}}, the files sorted by path.
+    """
+    groups = {}
+    for dirs, folders, files in os.walk(root):
+        for filename in sorted(files):
+            if not filename.lower().endswith((".tif", ".tiff")):
+                continue
+            file = os.path.join(dirs, filename)
+            organism, *folders = os.path.relpath(dirs, root).split(os.sep)
+            diameter = next((x for x in folders if x in DIAMETERS), None)
+            rest = [x for x in folders if x != diameter and not BATCH_PATTERN.match(x)]
+            if diameter is None:
+                raise ValueError(f"{file} is not under a folder named after a diameter {DIAMETERS}")
+            concentration = "_".join(rest) or "blank"
+            groups.setdefault((organism, concentration), {d: [] for d in DIAMETERS})[diameter].append(file)
+    for group in groups.values():
+        for files in group.values():
+            files.sort()
+    return groups
+
+
+def pairing(num):
+    """
+    The ranks of the 5nm, 13nm and 60nm images of every merged image, in the order of "Merge three pictures.py".
+
+    Returns:
+        A ndarray of shape (3 * num, 3).
+    """
+    interval = num // 3
+    n = np.arange(num)
+    return np.concatenate([np.stack((n, (n + i * interval) % num, (n + 2 * i * interval) % num), axis=1)
+                           for i in range(3)]) if num else np.empty((0, 3), dtype=int)
+
+
+def split_by_fold(group, folds):
+    """
+    Split the images of a group of scan() by their fold.
+
+    Args:
+        group: A dict {diameter: [files]}.
+        folds: A dict that maps the absolute path of every image to its fold, or None.
+
+    Returns:
+        A list of (fold, {diameter: [files]}), sorted by fold, [(None, group)] if folds is None.
+    """
+    if folds is None:
+        return [(None, group)]
+    split = {}
+    for diameter, files in group.items():
+        for file in files:
+            fold = folds.get(os.path.abspath(file))
+            if fold is None:
+                raise ValueError(f"{file} is not in the split manifest")
+            split.setdefault(fold, {d: [] for d in DIAMETERS})[diameter].append(file)
+    return sorted(split.items())
+
+
+def ingest(input_root, output, feature_num=225, workers=None, tiff=False, manifest=None):
+    """
+    Turn the raw images under input_root into the merged histogram vectors in one pass.
+
+    Args:
+        input_root: The folder of the raw 16-bit images, see scan().
+        output: The prefix of the output files, and the folder of the merged TIFFs.
+        feature_num: The number of gray values (features) for each gray histogram, the default is 225.
+        workers: The number of threads, the default is None, which uses all cores.
+        tiff: Whether to write the merged TIFFs, the default is False.
+        manifest: The split of the raw images, a DataFrame or the path of its csv with the columns
+         file (relative to input_root) and fold, see Utils.splits.split_raw(). The images are
+         paired within their fold. The default is None, which pairs the images of the whole tree.
+
+    Returns:
+        X: The merged histogram vectors, of shape (n_images, 3 * feature_num).
+        meta: A DataFrame with the fold, organism, concentration, file and sources of every row of X.
+    """
+    dtype = FEATURE_DTYPES["Merged"]
+    features, rows = [], []
+    folds = None
+    if manifest is not None:
+        manifest = manifest if isinstance(manifest, pd.DataFrame) else pd.read_csv(manifest)
+        folds = {os.path.abspath(os.path.join(input_root, file)): fold
+                 for file, fold in zip(manifest["file"], manifest["fold"])}
+
+    def work(file):
+        img_8, _, _ = to_8bit(cv2.imread(file, cv2.IMREAD_UNCHANGED))
+        img_8 = cv2.resize(img_8, (256, 256))
+        return batch_histograms(img_8[np.newaxis], "Single", feature_num, dtype=dtype)[0], img_8 if tiff else None
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        for (organism, concentration), whole in sorted(scan(input_root).items()):
+            for fold, group in split_by_fold(whole, folds):
+                lengths = {len(files) for files in group.values()}
+                if len(lengths) != 1:
+                    raise ValueError(f"{organism} {concentration} {fold or ''}: the diameters have different numbers "
+                                     f"of images { {d: len(files) for d, files in group.items()} }")
+                files = [file for d in DIAMETERS for file in group[d]]
+                hists, images = zip(*executor.map(work, files)) if files else ((), ())
+                num = lengths.pop()
+                ranks = pairing(num) + np.arange(3) * num
+                features.append(np.asarray(hists, dtype=dtype).reshape(-1, feature_num)[ranks].reshape(len(ranks), -1))
+
+                folder = os.path.join(output, fold, organism) if fold else os.path.join(output, organism)
+                for k, rank in enumerate(ranks):
+                    name = f"{concentration}_{k}.tif"
+                    if tiff:
+                        os.makedirs(folder, exist_ok=True)
+                        cv2.imwrite(os.path.join(folder, name), cv2.merge([images[r] for r in rank]))
+                    rows.append([fold, organism, concentration, os.path.join(folder, name)] +
+                                [os.path.relpath(files[r], input_root) for r in rank])
+                print(organism, concentration, fold or "", len(ranks))
+
+    X = np.concatenate(features) if features else np.empty((0, 3 * feature_num), dtype=dtype)
+    meta = pd.DataFrame(rows, columns=["fold", "organism", "concentration", "file"] + list(DIAMETERS))
+    prefix = f"{os.path.normpath(output)}_Merged_{feature_num}"
+    np.save(f"{prefix}.npy", X)
+    meta.to_csv(f"{prefix}.csv", index=False)
+    if tiff:
+        # every fold is a tree of its own, read with its own FeatureCache
+        for fold, rows_of_fold in meta.groupby(meta["fold"].fillna(""), sort=True):
+            root = os.path.join(output, fold) if fold else output
+            rows_of = {os.path.abspath(file): i for file, i in zip(rows_of_fold["file"], rows_of_fold.index)}
+            FeatureCache(root, "Merged", feature_num).get(
+                list(rows_of_fold["file"]), lambda files: X[[rows_of[os.path.abspath(file)] for file in files]])
+    return X, meta
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest raw 16-bit images into merged histogram features.")
+    parser.add_argument("input")
+    parser.add_argument("output")
+    parser.add_argument("--feature_num", type=int, default=225)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--tiff", action="store_true")
+    parser.add_argument("--split", default=None, help="a split manifest of the raw images")
+    parser.add_argument("--ratio", type=float, default=None, help="split the raw images with this test ratio")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    manifest = args.split
+    if args.ratio is not None:
+        from Utils.splits import split_raw
+
+        manifest = split_raw(args.input, args.ratio, args.seed)
+        manifest.to_csv(f"{os.path.normpath(args.output)}_split.csv", index=False)
+    ingest(args.input, args.output, args.feature_num, args.workers, args.tiff, manifest)
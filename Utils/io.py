@@ -1,59 +1,191 @@
 import glob
+import hashlib
 import json
 import os
 import pickle
+import shutil
+import tempfile
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from multiprocessing.util import Finalize
 
 import cv2
 import numpy as np
 import pandas as pd
 
+from Utils.cache import FeatureCache
+from Utils.features import (FEATURE_DTYPES, batch_histograms, compact_features, trans_to_single_glh,
+                            trans_to_merged_glh)
+from Utils.model_store import MANIFEST, linear_path, load_arrays, save_arrays, store_path
+from Utils.results import default_columns, export_all, get_store, insert_row, output_path
 
-def trans_to_single_glh(img, feature_num=225):
+SHARED_ROOT = os.environ.get("SHARED_ARRAY_DIR", "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir())
+_shared_arrays = {}
+_shared_users = Counter()
+_shared_pinned = set()
+
+
+def load_img(file):
     """
-    It is used to extract the grayscale histogram of the image and intercept the grayscale range
-    of 0-225 as a one-dimensional vector output.
+    Read an image without changing its depth or channels and resize it to 256x256.
 
     Args:
-        img: Input image.
-        feature_num: The number of gray values (features) for each gray histogram. The value of a
-         grayscale histogram without threshold restriction is 256, and that of a grayscale histogram
-          with threshold restriction is 225. The default value is 225.
+        file: The path of the image.
 
     Returns:
-        A one-dimensional vector of a grayscale histogram with grayscale values in the range 0-225.
+        The resized image.
+    """
+    img = cv2.imread(file, cv2.IMREAD_UNCHANGED)
+    return cv2.resize(img, (256, 256))
+
+
+def list_img(path, concentration="all"):
+    """
+    List the images under path in the order used by read_img, together with their labels.
+
+    Args:
+        path: the path of folder that contains the images
+        concentration: the concentration of the images, default is "all"
+
+    Returns:
+        files: a list of the paths of the images
+        labels: a list of the labels of the images
+    """
+    files = []
+    labels = []
+    if concentration == "all":
+        organisms = [os.path.join(path, x) for x in os.listdir(path)]
+        concentration = ""
+    else:
+        organisms = [os.path.join(path, x) for x in os.listdir(path) if x != "xBlank"]
+    for index, organism in enumerate(organisms):
+        for file in glob.glob(f'{organism}/*{concentration}*.tif'):
+            files.append(file)
+            labels.append(index)
+    return files, labels
+
+
+def extract_features(files, model_type, feature_num=225, workers=None, chunk_size=64, dtype=None):
     """
+    Decode the images and extract their histograms into one preallocated matrix.
+
+    The files are decoded in chunks of chunk_size, and the histograms of every chunk are calculated
+    together by batch_histograms(). With workers > 1 the chunks are handed to a thread pool.
+    cv2.imread and cv2.resize release the GIL, so the threads decode in parallel without the cost
+    of sending images or histograms between processes. Every chunk writes its rows straight into
+    the output matrix, therefore the order of the rows always follows files.
+
+    Args:
+        files: The paths of the images.
+        model_type: The form of data accepted by the model. It can be "Single" or "Merged".
+        feature_num: The number of gray values (features) for each gray histogram, the default is 225.
+        workers: The number of threads, None or 1 decodes the images serially. -1 uses all cores.
+        chunk_size: The number of images handed to a thread at a time, the default is 64.
+        dtype: The dtype of the matrix, the default is FEATURE_DTYPES[model_type].
 
-    hist = cv2.calcHist([img], [0], None, [256], [0, 256])
-    hist = hist[:feature_num, ]
-    return hist.ravel()
+    Returns:
+        A ndarray of shape (len(files), n_features) whose i-th row is the histogram of files[i].
+    """
+    n_features = feature_num if model_type == "Single" else 3 * feature_num
+    images = np.empty((len(files), n_features), dtype=dtype or FEATURE_DTYPES[model_type])
+
+    def work(start):
+        stop = min(start + chunk_size, len(files))
+        stack = np.stack([load_img(file) for file in files[start:stop]])
+        batch_histograms(stack, model_type, feature_num, out=images[start:stop])
+
+    starts = range(0, len(files), chunk_size)
+    if workers == -1:
+        workers = os.cpu_count()
+    if workers is None or workers <= 1 or len(starts) <= 1:
+        for start in starts:
+            work(start)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(work, starts))
+    return images
 
 
-def trans_to_merged_glh(img, feature_num=225):
+def shared_array(X):
     """
-    It is used to extract the gray histogram of the three-channel image (each channel stores an
-    AuNPs gray image), and intercepts the range of gray value 0-225 as a one-dimensional vector,
-    and finally splits the three one-dimensional vectors into a one-dimensional vector according
-    to the order of "AuNPs1, AuNPs2, AuNPs3".
+    Return X as a read-only memory-mapped copy in shared memory (/dev/shm, or SHARED_ARRAY_DIR).
+
+    joblib sends a memory-mapped array to its workers as a reference to the file, so the workers of
+    cross_validation() or cross_val_score() attach to the same pages instead of receiving a pickled
+    copy, and only the indices of the folds are sent per task. A matrix is written once per process:
+    an identical matrix, e.g. the same X_test evaluated by several models, maps the same file. The
+    array may be kept by the caller, so its file is only removed when the process exits; shared()
+    maps a matrix for the duration of a block instead.
 
     Args:
-        img: Input three channel picture.
-        feature_num: The number of gray values (features) for each gray histogram. The value of a
-         grayscale histogram without threshold restriction is 256, and that of a grayscale histogram
-          with threshold restriction is 225. The default value is 225.
+        X: The feature matrix. A np.memmap or a sparse matrix is returned unchanged.
 
     Returns:
-        A one-dimensional vector composed of three one-dimensional vectors.
+        A read-only np.memmap with the content of X.
     """
+    if isinstance(X, np.memmap) or not isinstance(X, np.ndarray):
+        return X
+    key = _share(X)
+    _shared_pinned.add(key)
+    return _shared_arrays[key][0]
+
 
-    hist_list = []
-    for i in range(3):
-        hist = cv2.calcHist([img], [i], None, [256], [0, 255])
-        hist_new = hist[:feature_num, ]
-        hist_list.append(hist_new.ravel().astype(np.uint16))
-    return np.hstack(hist_list)
+@contextmanager
+def shared(X):
+    """
+    Map X in shared memory as shared_array() does, for the duration of the block. The file is
+    removed when the last block that uses the same matrix ends, unless shared_array() has handed
+    it out as well. The pages stay valid for the processes that still map them.
 
+    Args:
+        X: The feature matrix. A np.memmap or a sparse matrix is used unchanged.
 
-def read_img(path, model_type, concentration="all", feature_num=225):
+    Yields:
+        A read-only np.memmap with the content of X.
+    """
+    if isinstance(X, np.memmap) or not isinstance(X, np.ndarray):
+        yield X
+        return
+    key = _share(X)
+    _shared_users[key] += 1
+    try:
+        yield _shared_arrays[key][0]
+    finally:
+        _shared_users[key] -= 1
+        if not _shared_users[key] and key not in _shared_pinned:
+            del _shared_users[key]
+            _, path = _shared_arrays.pop(key)
+            os.remove(path)
+
+
+def _share(X):
+    """Write X to a file of the shared folder unless an identical matrix is mapped, return its key."""
+    X = np.ascontiguousarray(X)
+    digest = hashlib.sha1(X.data.cast("B")).hexdigest()[:16]
+    key = (digest, X.shape, X.dtype.str)
+    if key not in _shared_arrays:
+        # the shape and dtype are part of the name, so a file that is mapped is never rewritten
+        name = f"{digest}_{'x'.join(map(str, X.shape))}_{X.dtype.name}.npy"
+        path = os.path.join(_shared_folder(), name)
+        tmp = os.path.join(_shared_folder(), f".{name}")
+        np.save(tmp, X)
+        os.replace(tmp, path)
+        _shared_arrays[key] = (np.load(path, mmap_mode="r"), path)
+    return key
+
+
+@lru_cache(maxsize=None)
+def _shared_folder():
+    folder = tempfile.mkdtemp(prefix="shared_", dir=SHARED_ROOT)
+    # unlike atexit, Finalize also runs in the processes of a multiprocessing pool
+    Finalize(None, shutil.rmtree, args=(folder, True), exitpriority=0)
+    return folder
+
+
+def read_img(path, model_type, concentration="all", feature_num=225, cache=True, workers=None, dtype=None,
+             sparse=False, share=False):
     """
     read images from path, return the histogram of the images and the labels
 
@@ -64,47 +196,111 @@ def read_img(path, model_type, concentration="all", feature_num=225):
         feature_num: The number of gray values (features) for each gray histogram. The value of a
           grayscale histogram without threshold restriction is 256, and that of a grayscale histogram
           with threshold restriction is 225. The default value is 225.
+        cache: Whether to reuse the histograms stored by FeatureCache, so that only new or changed
+          images are decoded. It can also be the folder of the cache. The default is True.
+        workers: The number of threads used to decode the images, see extract_features(). The
+          default is None, which decodes the images serially.
+        dtype: The dtype the histograms are stored in, see compact_features(). The default is None,
+          which keeps float32 for "Single" and uint16 for "Merged".
+        sparse: Whether to return the histograms as a scipy.sparse.csr_matrix, the default is False.
+        share: Whether to return the histograms memory-mapped in shared memory, see shared_array().
+          The default is False.
 
     Returns:
         images: a ndarray of the histogram of the images
         labels: a ndarray of the labels of the images
     """
-    images = []
-    labels = []
-    if model_type == "Single":
-        trans = trans_to_single_glh
-    else:
-        trans = trans_to_merged_glh
-    if concentration == "all":
-        organisms = [os.path.join(path, x) for x in os.listdir(path)]
-        concentration = ""
-    else:
-        organisms = [os.path.join(path, x) for x in os.listdir(path) if x != "xBlank"]
-    for index, organism in enumerate(organisms):
-        for file in glob.glob(f'{organism}/*{concentration}*.tif'):
-            img = cv2.imread(file, cv2.IMREAD_UNCHANGED)
-            img = cv2.resize(img, (256, 256))
-            images.append(trans(img, feature_num))
-            labels.append(index)
-    return np.array(images), np.array(labels)
+    files, labels = list_img(path, concentration)
+    images = compact_features(read_files(path, files, model_type, feature_num, cache, workers), dtype, sparse)
+    return shared_array(images) if share else images, np.array(labels)
+
+
+def read_files(path, files, model_type, feature_num=225, cache=True, workers=None):
+    """
+    Return the histograms of the given images under path, through the FeatureCache of path.
+
+    Args:
+        path: The folder the images are located under, the root of the cache.
+        files: The paths of the images.
+        model_type: The form of data accepted by the model. It can be "Single" or "Merged".
+        feature_num: The number of gray values (features) for each gray histogram, the default is 225.
+        cache: Whether to use the FeatureCache, or the folder of the cache, see read_img().
+        workers: The number of threads used to decode the images, see extract_features().
+
+    Returns:
+        A ndarray whose i-th row is the histogram of files[i].
+    """
+    def extract(files):
+        return extract_features(files, model_type, feature_num, workers)
+
+    if cache and files:
+        cache_root = cache if isinstance(cache, str) else None
+        return FeatureCache(path, model_type, feature_num, cache_root).get(files, extract)
+    return extract(files)
+
+
+def iter_batches(path, model_type, batch_size=256, concentration="all", feature_num=225, workers=None,
+                 random_state=None):
+    """
+    Read the images under path batch by batch, for models that are fitted incrementally (e.g.
+    IncrementalPCA or SGDClassifier with partial_fit) on more images than fit in memory.
+
+    Only the file list is kept for the whole dataset. The histograms of one batch are extracted into
+    a fresh (batch_size, n_features) matrix, so the memory used does not grow with the dataset. The
+    labels are the same as those returned by read_img for the same arguments.
+
+    Args:
+        path: the path of folder that contains the images
+        model_type: The form of data accepted by the model. It can be "Single" or "Merged".
+        batch_size: The number of images in each batch, the default is 256.
+        concentration: the concentration of the images, default is "all"
+        feature_num: The number of gray values (features) for each gray histogram, the default is 225.
+        workers: The number of threads used to decode the images, see extract_features().
+        random_state: If not None, the images are visited in an order shuffled with this seed, which
+          SGD-style models need. The default is None, which keeps the order of read_img.
+
+    Yields:
+        X_batch: a ndarray of the histogram of the images in the batch
+        y_batch: a ndarray of the labels of the images in the batch
+    """
+    files, labels = list_img(path, concentration)
+    labels = np.array(labels)
+    order = np.arange(len(files))
+    if random_state is not None:
+        np.random.default_rng(random_state).shuffle(order)
+    for start in range(0, len(files), batch_size):
+        batch = order[start:start + batch_size]
+        yield extract_features([files[i] for i in batch], model_type, feature_num, workers), labels[batch]
 
 
 def save_model(model, path):
     """
-    This function saves the model to the specified path through the dump() function of the pickle package.
+    This function saves the model to the specified path. A path ending with ".pkl" is written through
+    the dump() function of the pickle package, any other path (e.g. ending with ".model") is written
+    as an array store by Utils.model_store.save_arrays(), which loads much faster. The array store
+    and the collapsed copy made from an earlier version of a ".pkl" file are removed, so they never
+    shadow the new model. Within Utils.results.deferred() the ".pkl" file is only put in its place
+    by commit(), see output_path().
 
     Args:
         model: The model that needs to be saved.
         path: The path to save the model.
     """
-    with open(path, 'wb') as f:
+    if not path.endswith(".pkl"):
+        save_arrays(model, path)
+        return
+    with open(output_path(path), 'wb') as f:
         pickle.dump(model, f)
+    shutil.rmtree(store_path(path), ignore_errors=True)
+    shutil.rmtree(linear_path(path), ignore_errors=True)
 
 
 def load_model(model_dir):
     """
-    This function loads the model saved in the specified path through the load() function of
-    the pickle package.
+    This function loads the model saved in the specified path. An array store (see
+    Utils.model_store) is preferred: it is used when model_dir is one, or when model_dir is a
+    ".pkl" file that has been converted into an array store next to it and the store is not older
+    than the file. Otherwise the model is loaded through the load() function of the pickle package.
 
     Args:
         model_dir: The path to save the model.
@@ -112,12 +308,42 @@ def load_model(model_dir):
     Returns:
         The model is extracted from the specified path.
     """
-
+    if os.path.isdir(model_dir):
+        return load_arrays(model_dir)
+    manifest = os.path.join(store_path(model_dir), MANIFEST)
+    if os.path.exists(manifest) and os.path.getmtime(manifest) >= os.path.getmtime(model_dir):
+        return load_arrays(store_path(model_dir))
     with open(model_dir, 'rb') as file:
         model = pickle.load(file)
     return model
 
 
+def classes_path(model_path):
+    """The path of the class names of the model at model_path, see save_classes()."""
+    return os.path.splitext(model_path)[0] + ".classes.json"
+
+
+def save_classes(names, model_path):
+    """
+    Save the class names of a model next to it, so the labels of its classes_ can be named without
+    its training data.
+
+    Args:
+        names: The class names, names[label] is the name of the label in the classes_ of the model.
+        model_path: The path of the model, a ".pkl" file or an array store.
+    """
+    with open(classes_path(model_path), "w") as f:
+        json.dump(list(names), f)
+
+
+def load_classes(model_path):
+    """The class names saved by save_classes() for the model at model_path, None if there are none."""
+    if not os.path.exists(classes_path(model_path)):
+        return None
+    with open(classes_path(model_path), "r") as f:
+        return json.load(f)
+
+
 def load_param(param_dir):
     """
     This function loads the model parameters saved in the specified path through the load() function of
@@ -147,8 +373,7 @@ def create_table(table_path, column_names=None):
         print(f"{table_path} already exists.")
         return
     if column_names is None:
-        column_names = ["number_of_pictures", "diameter", "concentration", "Accuracy_score",
-                        "Recall", "F1_score", "Precision_score"] + [f"Score{i}" for i in range(1, 31)]
+        column_names = default_columns()
     df = pd.DataFrame(columns=column_names)
     df.to_excel(table_path, sheet_name="Sheet1", index=False)
 
@@ -157,14 +382,27 @@ def insert_into_table(new_data, table_path, column_names=None, sheet="Sheet1"):
     """
     Insert evaluation parameters into the table.
 
+    The row is appended to the ResultsStore next to the table instead of rewriting the whole Excel
+    file for every row. The Excel table is written by export_tables() or when the program exits.
+    Inside Utils.results.deferred(), e.g. in a task of Utils.scheduler, the row is only collected.
+
     Args:
         new_data: The model evaluation parameters that need to be inserted are a fixed format list.
         table_path: The path to the inserted table.
         column_names: The column name of the table, if the table does not exist, it will be column name of new table.
         sheet: The inserted Sheet. Sheet1 is inserted by default.
     """
-    if not os.path.exists(table_path):
-        create_table(table_path, column_names)
-    df = pd.read_excel(table_path, sheet_name=sheet, header=0, index_col=None)
-    df.loc[len(df)] = new_data
-    df.to_excel(table_path, sheet, index=False)
+    insert_row(new_data, table_path, column_names, sheet)
+
+
+def export_tables(table_path=None):
+    """
+    Write the rows inserted by insert_into_table() to their Excel tables.
+
+    Args:
+        table_path: Only export the rows of this table, the default is None, which exports all.
+    """
+    if table_path is not None:
+        get_store(table_path).export(table_path)
+    else:
+        export_all()
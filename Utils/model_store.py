@@ -0,0 +1,190 @@
+"""
+Array-based model store, an alternative to pickling the fitted pipelines.
+
+A model is saved as a folder ending with MODEL_SUFFIX. Every ndarray of the fitted estimators (the
+components of PCA/KernelPCA, the coefficients and means of LDA, the node and value arrays of every
+tree of a RandomForest, ...) is written uncompressed into one flat arrays.bin file, and
+manifest.json records the name, dtype, shape and offset of each array together with how the
+estimators are put back together from them. load_arrays() maps arrays.bin into memory once and
+hands out views into it, so loading is near-instant, only the pages that are used for predicting
+are read, and processes that load the same model share the pages through the page cache instead
+of holding a copy each.
+
+Usage:
+    python -m Utils.model_store <folder>    converts every .pkl model under folder.
+"""
+import importlib
+import json
+import os
+import pickle
+import sys
+
+import numpy as np
+from sklearn.base import BaseEstimator
+
+MODEL_SUFFIX = ".model"
+LINEAR_SUFFIX = ".linear"
+MANIFEST = "manifest.json"
+ARRAYS = "arrays.bin"
+ALIGNMENT = 64
+ALLOWED_MODULES = ("sklearn.", "Utils.")
+
+
+def _class_path(cls):
+    return f"{cls.__module__}:{cls.__qualname__}"
+
+
+def _import_class(path):
+    module, name = path.split(":")
+    if not module.startswith(ALLOWED_MODULES):
+        raise ValueError(f"Refusing to load the class {path} from a model store.")
+    return getattr(importlib.import_module(module), name)
+
+
+def _encode(obj, name, arrays):
+    """Turn obj into a JSON-able description, collecting its ndarrays in arrays."""
+    if obj is None or isinstance(obj, (bool, int, float, str)):
+        return obj
+    if isinstance(obj, np.ndarray):
+        if obj.dtype.hasobject:
+            return {"__objects__": [_encode(x, f"{name}.{i}", arrays) for i, x in enumerate(obj.tolist())],
+                    "shape": list(obj.shape)}
+        arrays[name] = obj
+        return {"__array__": name}
+    if isinstance(obj, np.generic):
+        return {"__scalar__": obj.dtype.str, "value": obj.item()}
+    if isinstance(obj, (list, tuple)):
+        items = [_encode(x, f"{name}.{i}", arrays) for i, x in enumerate(obj)]
+        return {"__tuple__": items} if isinstance(obj, tuple) else {"__list__": items}
+    if isinstance(obj, dict):
+        return {"__dict__": [[_encode(k, f"{name}.k{i}", arrays), _encode(v, f"{name}.{i}", arrays)]
+                             for i, (k, v) in enumerate(obj.items())]}
+    if isinstance(obj, BaseEstimator):
+        return {"__estimator__": _class_path(type(obj)), "state": _encode(obj.__getstate__(), name, arrays)}
+    if type(obj).__module__.startswith("sklearn."):
+        # Cython objects such as sklearn.tree._tree.Tree
+        cls, args, state = obj.__reduce__()[:3]
+        return {"__reduce__": _class_path(cls), "args": _encode(args, f"{name}.args", arrays),
+                "state": _encode(state, name, arrays)}
+    raise TypeError(f"Cannot store an object of type {type(obj)} in a model store.")
+
+
+def _decode(desc, arrays):
+    """Rebuild the object described by desc, taking its ndarrays from arrays."""
+    if not isinstance(desc, dict):
+        return desc
+    if "__array__" in desc:
+        return arrays(desc["__array__"])
+    if "__objects__" in desc:
+        objects = np.empty(len(desc["__objects__"]), dtype=object)
+        objects[:] = [_decode(x, arrays) for x in desc["__objects__"]]
+        return objects.reshape(desc["shape"])
+    if "__scalar__" in desc:
+        return np.dtype(desc["__scalar__"]).type(desc["value"])
+    if "__list__" in desc:
+        return [_decode(x, arrays) for x in desc["__list__"]]
+    if "__tuple__" in desc:
+        return tuple(_decode(x, arrays) for x in desc["__tuple__"])
+    if "__dict__" in desc:
+        return {_decode(k, arrays): _decode(v, arrays) for k, v in desc["__dict__"]}
+    if "__estimator__" in desc:
+        cls = _import_class(desc["__estimator__"])
+        obj = cls.__new__(cls)
+        obj.__setstate__(_decode(desc["state"], arrays))
+        return obj
+    if "__reduce__" in desc:
+        obj = _import_class(desc["__reduce__"])(*_decode(desc["args"], arrays))
+        obj.__setstate__(_decode(desc["state"], arrays))
+        return obj
+    raise ValueError(f"Unknown entry in the manifest: {desc}")
+
+
+def save_arrays(model, folder):
+    """
+    Save a fitted model as named NumPy arrays plus a manifest.
+
+    Args:
+        model: The fitted model, e.g. a PCA/KernelPCA + LDA Pipeline or a RandomForestClassifier.
+        folder: The folder to save the model in, it is created if it does not exist.
+    """
+    arrays = {}
+    manifest = {"model": _encode(model, "model", arrays), "arrays": {}}
+    os.makedirs(folder, exist_ok=True)
+    tmp = os.path.join(folder, f".{ARRAYS}.tmp")
+    with open(tmp, "wb") as f:
+        for name, array in arrays.items():
+            offset = -f.tell() % ALIGNMENT
+            f.write(b"\0" * offset)
+            manifest["arrays"][name] = {"dtype": np.lib.format.dtype_to_descr(array.dtype),
+                                        "shape": list(array.shape), "offset": f.tell()}
+            f.write(np.ascontiguousarray(array).tobytes())
+    os.replace(tmp, os.path.join(folder, ARRAYS))
+    tmp = os.path.join(folder, f".{MANIFEST}.tmp")
+    with open(tmp, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp, os.path.join(folder, MANIFEST))
+
+
+def load_arrays(folder, mmap=True):
+    """
+    Load a model saved by save_arrays().
+
+    Args:
+        folder: The folder the model is saved in.
+        mmap: Whether to map the arrays into memory (read-only) instead of reading them, the default
+         is True.
+
+    Returns:
+        The fitted model.
+    """
+    with open(os.path.join(folder, MANIFEST), "r") as f:
+        manifest = json.load(f)
+    path = os.path.join(folder, ARRAYS)
+    if os.path.getsize(path) == 0:
+        buffer = np.empty(0, dtype=np.uint8)
+    elif mmap:
+        buffer = np.memmap(path, dtype=np.uint8, mode="r")
+    else:
+        buffer = np.fromfile(path, dtype=np.uint8)
+
+    def arrays(name):
+        entry = manifest["arrays"][name]
+        dtype = np.lib.format.descr_to_dtype(entry["dtype"])
+        size = dtype.itemsize * int(np.prod(entry["shape"]))
+        return buffer[entry["offset"]:entry["offset"] + size].view(dtype).reshape(entry["shape"])
+
+    return _decode(manifest["model"], arrays)
+
+
+def store_path(pkl_path):
+    """The folder of the array store that belongs to a .pkl model."""
+    return os.path.splitext(pkl_path)[0] + MODEL_SUFFIX
+
+
+def linear_path(pkl_path):
+    """
+    The folder of the collapsed copy (see Utils.predict.collapse_linear_models()) of a .pkl model.
+    load_model() never loads it, it is only used by the callers that ask for it.
+    """
+    return os.path.splitext(pkl_path)[0] + LINEAR_SUFFIX
+
+
+def convert(root):
+    """
+    Convert every .pkl model under root into an array store next to it.
+
+    Args:
+        root: The folder to search for .pkl files.
+    """
+    for dirs, _, files in os.walk(root):
+        for file in sorted(files):
+            if file.endswith(".pkl"):
+                path = os.path.join(dirs, file)
+                with open(path, "rb") as f:
+                    model = pickle.load(f)
+                save_arrays(model, store_path(path))
+                print(f"{path} -> {store_path(path)}")
+
+
+if __name__ == "__main__":
+    convert(sys.argv[1] if len(sys.argv) > 1 else ".")
@@ -6,3 +6,17 @@ ORGANISMS = ["B.licheniformis", "E.cloacae", "E.coli", "E.faecalis", "L.monocyto
 BLANK = "xBlank"
 ORGANISMS_WITH_BLANK = ORGANISMS + [BLANK]
 CONCENTRATIONS = ["10^4", "10^5", "10^6", "all"]
+ORDERS = ["Bacillales", "Enterobacteriales", "E.faecalis", "S.cerevisiae", "xBlank"]
+ORDER_TO_SPECIES = {
+    "Bacillales": ["B.licheniformis", "L.monocytogenes", "S.aureus"] + ["xBlank"],
+    "Enterobacteriales": ["E.cloacae", "E.coli", "S.enterica", "S.marcescens", ] + ["xBlank"],
+    "Lactobacillales": ["E.faecalis"] + ["xBlank"],
+    "Saccharomycetales": ["S.cerevisiae"] + ["xBlank"],
+    "xBlank": ["xBlank"]
+}
+OTHERS = "xxothers"
+
+
+def class_names(names, concentration):
+    """The class names of a model trained on one concentration, xBlank is only used with "all"."""
+    return list(names) if concentration == "all" else [x for x in names if x != BLANK]
@@ -0,0 +1,466 @@
+"""
+Fast predictors assembled from the fitted models.
+
+Usage:
+    python -m Utils.predict <folder>    collapses every linear PCA/KernelPCA -> LDA model under folder
+                                        into a LinearPipeline next to it, see collapse_linear_models().
+"""
+import os
+import pickle
+import sys
+
+import numpy as np
+from scipy.special import expit, softmax
+from sklearn.base import BaseEstimator, ClassifierMixin
+from sklearn.decomposition import PCA, KernelPCA
+from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.pipeline import Pipeline
+
+from Utils.io import load_model, save_model
+from Utils.model_store import MANIFEST, linear_path
+from Utils.names import BLANK, ORDER_TO_SPECIES, ORDERS, ORGANISMS_WITH_BLANK, class_names
+
+
+def projection_affine(step, n_features):
+    """
+    The affine map of a fitted linear projection, transform(X) = X @ P + c.
+
+    Args:
+        step: A fitted PCA, or a KernelPCA with the linear kernel.
+        n_features: The number of features the step was fitted on.
+
+    Returns:
+        P: A ndarray of shape (n_features, n_components).
+        c: A ndarray of shape (n_components,).
+    """
+    if isinstance(step, PCA):
+        P = step.components_.T
+        if step.whiten:
+            P = P / np.sqrt(step.explained_variance_)
+        return P, -step.mean_ @ P
+    # the centred linear kernel is affine in X, so the map is read off the images of 0 and of the
+    # unit vectors, which costs one kernel against the training samples instead of one per query
+    c = step.transform(np.zeros((1, n_features)))[0]
+    return step.transform(np.eye(n_features)) - c, c
+
+
+def is_linear_pipeline(model):
+    """Whether the model is a fitted Pipeline of linear projections followed by an LDA."""
+    return (isinstance(model, Pipeline) and isinstance(model.steps[-1][1], LinearDiscriminantAnalysis)
+            and all(isinstance(step, PCA) or (isinstance(step, KernelPCA) and step.kernel == "linear")
+                    for _, step in model.steps[:-1]))
+
+
+def pipeline_affine(pipeline):
+    """
+    Collapse a fitted linear pipeline (see is_linear_pipeline()) into the affine map of its
+    decision function, decision_function(X) = X @ W + b.
+
+    Args:
+        pipeline: A fitted Pipeline of PCA / linear KernelPCA steps and a LinearDiscriminantAnalysis.
+
+    Returns:
+        W: A ndarray of shape (n_features, n_classes), (n_features, 1) for two classes.
+        b: A ndarray of shape (n_classes,), (1,) for two classes.
+    """
+    W = np.eye(pipeline.n_features_in_)
+    b = np.zeros(pipeline.n_features_in_)
+    for _, step in pipeline.steps[:-1]:
+        P, c = projection_affine(step, W.shape[1])
+        W, b = W @ P, b @ P + c
+    lda = pipeline.steps[-1][1]
+    return W @ lda.coef_.T, b @ lda.coef_.T + lda.intercept_
+
+
+def pca_lda_affine(pipeline):
+    """
+    Collapse a fitted binary linear pipeline into decision_function(X) = X @ w + b.
+
+    Returns:
+        w: A ndarray of shape (n_features,).
+        b: A float.
+    """
+    if isinstance(pipeline, LinearPipeline):
+        return pipeline.coef_[:, 0], pipeline.intercept_[0]
+    W, b = pipeline_affine(pipeline)
+    return W[:, 0], b[0]
+
+
+def is_binary_pca_lda(model):
+    """Whether the model is a fitted linear pipeline (see is_linear_pipeline()), or its LinearPipeline, of two classes."""
+    return (is_linear_pipeline(model) or isinstance(model, LinearPipeline)) and len(model.classes_) == 2
+
+
+class LinearPipeline(ClassifierMixin, BaseEstimator):
+    """
+    A fitted PCA / linear KernelPCA -> LDA pipeline collapsed into one dense affine map.
+
+    KernelPCA(kernel="linear") computes a kernel against every training sample at predict time and
+    stores all of them, but the projection it learns is linear, and so is the LDA after it. The
+    collapsed model keeps one (n_features, n_classes) matrix and the intercepts, so predicting costs
+    O(n_features * n_classes) and the model takes kilobytes. Built with from_pipeline().
+    """
+
+    @classmethod
+    def from_pipeline(cls, pipeline):
+        """Collapse a fitted linear pipeline, see is_linear_pipeline()."""
+        model = cls()
+        model.coef_, model.intercept_ = pipeline_affine(pipeline)
+        model.classes_ = pipeline.classes_
+        model.n_features_in_ = pipeline.n_features_in_
+        return model
+
+    def decision_function(self, X):
+        decision = np.asarray(X) @ self.coef_ + self.intercept_
+        return decision[:, 0] if len(self.classes_) == 2 else decision
+
+    def predict_proba(self, X):
+        """The probabilities of LinearDiscriminantAnalysis.predict_proba()."""
+        decision = self.decision_function(X)
+        if len(self.classes_) == 2:
+            proba = expit(decision)
+            return np.column_stack([1 - proba, proba])
+        return softmax(decision, axis=1)
+
+    def predict(self, X):
+        decision = self.decision_function(X)
+        if len(self.classes_) == 2:
+            return self.classes_[(decision > 0).astype(int)]
+        return self.classes_[decision.argmax(axis=1)]
+
+
+def class_index(model, label):
+    """The column of the class label in predict_proba() of a fitted model."""
+    index = np.flatnonzero(np.asarray(model.classes_) == label)
+    if not len(index):
+        raise ValueError(f"{label!r} is not one of the classes {list(model.classes_)}")
+    return int(index[0])
+
+
+def target_label(folder, target, concentration="all"):
+    """
+    The label read_img() gives the images of target under folder, e.g. the train folder of a
+    Dichotomies split. Every model trained on the folder has this label in its classes_.
+    """
+    organisms = [x for x in os.listdir(folder) if concentration == "all" or x != BLANK]
+    return organisms.index(target)
+
+
+class ForestEnsemble:
+    """
+    All the trees of several fitted RandomForestClassifiers flattened into one set of node arrays,
+    so that every tree of every forest is traversed for all samples together, one tree level per
+    vectorized step.
+
+    Args:
+        forests: A list of fitted RandomForestClassifier with the same features.
+        positive: The label (an entry of classes_) of the class whose probability is returned, one
+         per forest, or one label for all of them. The default is 0.
+    """
+
+    def __init__(self, forests, positive=0):
+        left, right, feature, threshold, proba, roots, owner = [], [], [], [], [], [], []
+        offset = 0
+        positive = np.broadcast_to(np.asarray(positive, dtype=object), (len(forests),))
+        for f, forest in enumerate(forests):
+            column = class_index(forest, positive[f])
+            for estimator in forest.estimators_:
+                tree = estimator.tree_
+                leaf = tree.children_left == -1
+                left.append(np.where(leaf, np.arange(tree.node_count), tree.children_left) + offset)
+                right.append(np.where(leaf, np.arange(tree.node_count), tree.children_right) + offset)
+                feature.append(np.where(leaf, 0, tree.feature))
+                threshold.append(tree.threshold)
+                value = tree.value[:, 0, :]
+                proba.append(value[:, column] / value.sum(axis=1))
+                roots.append(offset)
+                owner.append(f)
+                offset += tree.node_count
+        self.left = np.concatenate(left)
+        self.right = np.concatenate(right)
+        self.feature = np.concatenate(feature)
+        self.threshold = np.concatenate(threshold)
+        self.proba = np.concatenate(proba)
+        self.roots = np.array(roots)
+        self.owner = np.array(owner)
+        self.n_forests = len(forests)
+        self.n_trees = np.bincount(self.owner, minlength=self.n_forests)
+        self.depth = max(estimator.tree_.max_depth for forest in forests for estimator in forest.estimators_)
+
+    def predict_proba(self, X):
+        """
+        Args:
+            X: Features of the data.
+
+        Returns:
+            A ndarray of shape (n_samples, n_forests) with the probability of the positive class.
+        """
+        # the trees of sklearn compare float32 features with float64 thresholds
+        X = np.asarray(X, dtype=np.float32)
+        rows = np.arange(len(X))[:, np.newaxis]
+        node = np.broadcast_to(self.roots, (len(X), len(self.roots)))
+        for _ in range(self.depth):
+            go_left = X[rows, self.feature[node]] <= self.threshold[node]
+            node = np.where(go_left, self.left[node], self.right[node])
+        # the trees of each forest are contiguous, so their leaves are summed per forest by reduceat
+        starts = np.concatenate(([0], np.cumsum(self.n_trees)[:-1]))
+        return np.add.reduceat(self.proba[node], starts, axis=1) / self.n_trees
+
+
+class AllTargetsPredictor:
+    """
+    Score every sample against all the one-vs-rest Dichotomies models in a single pass.
+
+    Binary linear pipelines are collapsed into one (n_features, n_targets) matrix, so the
+    decision functions of all the targets come out of one matrix product. RandomForest models are
+    merged into one ForestEnsemble. Any other model is scored on its own.
+
+    The label of the target in each model is the index read_img() gave the folder of the target
+    when the model was trained, which follows os.listdir() of the training folder, see target_label().
+
+    Args:
+        models: A dict that maps each target to its fitted one-vs-rest model.
+        positive: A dict that maps each target to the label of the target in its model, or None,
+         which uses the label 0 for every target.
+    """
+
+    def __init__(self, models, positive=None):
+        self.targets = list(models)
+        self.positive = [0 if positive is None else positive[target] for target in self.targets]
+        # the column of the target in predict_proba() of each model
+        self.columns = [class_index(model, label) for model, label in zip(models.values(), self.positive)]
+        self.linear = [i for i, model in enumerate(models.values()) if is_binary_pca_lda(model)]
+        self.forest = [i for i, model in enumerate(models.values()) if isinstance(model, RandomForestClassifier)]
+        self.other = [(i, model) for i, model in enumerate(models.values())
+                      if i not in self.linear and i not in self.forest]
+        models = list(models.values())
+        self.n_features_in_ = models[0].n_features_in_
+        if self.linear:
+            affine = [pca_lda_affine(models[i]) for i in self.linear]
+            self.W = np.column_stack([w for w, _ in affine])
+            self.b = np.array([b for _, b in affine])
+            # the decision function of a two-class LDA is the one of its second class
+            self.sign = np.array([1.0 if self.columns[i] == 1 else -1.0 for i in self.linear])
+        if self.forest:
+            self.ensemble = ForestEnsemble([models[i] for i in self.forest], [self.positive[i] for i in self.forest])
+
+    def predict_proba(self, X):
+        """
+        Args:
+            X: Features of the data.
+
+        Returns:
+            A ndarray of shape (n_samples, n_targets), the probability of each target for each sample.
+        """
+        X = np.asarray(X)
+        proba = np.empty((len(X), len(self.targets)))
+        if self.linear:
+            # P(class 1) = expit(decision) for a two-class LDA
+            decision = X @ self.W + self.b
+            proba[:, self.linear] = expit(decision * self.sign)
+        if self.forest:
+            proba[:, self.forest] = self.ensemble.predict_proba(X)
+        for i, model in self.other:
+            proba[:, i] = model.predict_proba(X)[:, self.columns[i]]
+        return proba
+
+    def predict(self, X):
+        """Return the most probable target of each sample."""
+        return np.array(self.targets)[self.predict_proba(X).argmax(axis=1)]
+
+
+def load_all_targets(model_dir, identifier, concentration, targets, positive=None):
+    """
+    Load the one-vs-rest models of the given targets and fuse them into an AllTargetsPredictor.
+
+    Args:
+        model_dir: The folder of the models, e.g. "./model".
+        identifier: The identifier of the models, e.g. "Dichotomies_merged".
+        concentration: The concentration of the models.
+        targets: The targets to load, e.g. ORGANISMS.
+        positive: A dict that maps each target to its label, see AllTargetsPredictor. The default
+         is None.
+
+    Returns:
+        An AllTargetsPredictor.
+    """
+    models = {target: load_model(f"{model_dir}/{identifier}_{target}_{concentration}.pkl") for target in targets}
+    return AllTargetsPredictor(models, positive)
+
+
+class HierarchicalClassifier:
+    """
+    A classifier that first predicts a coarse class with the root model and passes the samples of
+    some coarse classes on to a branch model that refines them.
+
+    Labels are routed as integer codes: the prediction of every model is turned into the index of
+    the final class by a lookup table built once, and each branch model only sees its own rows.
+
+    predict_cascade() gates every level by the probability of its prediction: a sample whose root
+    probability is below thresholds[0] stops at the root and is labelled with the root class, so
+    the branch model is not run for it, and a sample whose branch probability is below
+    thresholds[1] falls back to the root class as well. The root classes without a branch always
+    stop at the root.
+
+    Args:
+        root: The fitted root model.
+        root_classes: The names of the classes of the root model, in the order of its classes_.
+        branches: A dict that maps some of root_classes to the fitted model that refines them.
+        branch_classes: A dict that maps the same names to the class names of their branch model.
+        classes: The names of the final classes.
+        thresholds: The probability thresholds (root, branch) of predict_cascade(), the default is
+         (0.0, 0.0), which never stops a sample early.
+    """
+
+    def __init__(self, root, root_classes, branches, branch_classes, classes, thresholds=(0.0, 0.0)):
+        self.root = root
+        self.classes = list(classes)
+        self.root_classes = list(root_classes)
+        self.thresholds = thresholds
+        # the codes from len(classes) on stand for the root classes, used by predict_cascade()
+        self.class_array = np.array(self.classes + self.root_classes)
+        index = {name: i for i, name in enumerate(self.classes)}
+        self.branch_names = list(branches)
+        self.models = [branches[name] for name in self.branch_names]
+        # final class code of each root class, -1 for the classes that are refined by a branch
+        self.root_table = np.array([-1 if name in branches else index[name] for name in root_classes])
+        self.branch_of = np.array([self.branch_names.index(name) if name in branches else -1
+                                   for name in root_classes])
+        self.tables = [np.array([index[name] for name in branch_classes[branch]]) for branch in self.branch_names]
+        self.n_features_in_ = root.n_features_in_
+
+    @staticmethod
+    def _positions(model, y):
+        """The positions of the predicted labels in classes_ of the model."""
+        return np.searchsorted(model.classes_, y)
+
+    def predict_codes(self, X, out=None):
+        """
+        Args:
+            X: Features of the data.
+            out: An optional integer ndarray of at least len(X) elements to write the codes into.
+
+        Returns:
+            A ndarray with the index of the predicted class in classes for each sample.
+        """
+        X = np.asarray(X)
+        position = self._positions(self.root, self.root.predict(X))
+        codes = np.take(self.root_table, position, out=None if out is None else out[:len(X)])
+        branch = self.branch_of[position]
+        for k, (model, table) in enumerate(zip(self.models, self.tables)):
+            rows = np.flatnonzero(branch == k)
+            if len(rows):
+                codes[rows] = table[self._positions(model, model.predict(X[rows]))]
+        return codes
+
+    def predict(self, X):
+        """Return the name of the predicted class of each sample."""
+        return self.class_array[self.predict_codes(X)]
+
+    def predict_proba(self, X):
+        """P(class) = P(root class) * P(class | root class) for the classes that are refined."""
+        X = np.asarray(X)
+        proba_root = self.root.predict_proba(X)
+        proba = np.zeros((len(X), len(self.classes)))
+        for j, (code, k) in enumerate(zip(self.root_table, self.branch_of)):
+            if k == -1:
+                proba[:, code] += proba_root[:, j]
+            else:
+                proba[:, self.tables[k]] += proba_root[:, j, np.newaxis] * self.models[k].predict_proba(X)
+        return proba
+
+    def predict_cascade(self, X, thresholds=None):
+        """
+        Predict with confidence gates, see the class documentation.
+
+        Args:
+            X: Features of the data.
+            thresholds: The probability thresholds (root, branch), the default is self.thresholds.
+
+        Returns:
+            y_pred: The name of the predicted class of each sample. It is one of classes, except for
+             the samples of a refined root class that stopped early: those are labelled with the
+             name of their root class, one of root_classes (e.g. "Bacillales"), which is not in
+             classes.
+            level: The deepest model run for each sample, 0 for the root and 1 for a branch.
+            exit_fraction: The fraction of the samples that stopped at the root.
+        """
+        root_threshold, branch_threshold = self.thresholds if thresholds is None else thresholds
+        X = np.asarray(X)
+        proba_root = self.root.predict_proba(X)
+        position = proba_root.argmax(axis=1)
+        confident = proba_root[np.arange(len(X)), position] >= root_threshold
+        codes = self.root_table[position]
+        branch = self.branch_of[position]
+        # the refined classes stop at their root class unless the branch model decides them
+        codes[branch != -1] = len(self.classes) + position[branch != -1]
+        level = np.zeros(len(X), dtype=np.int8)
+        for k, (model, table) in enumerate(zip(self.models, self.tables)):
+            rows = np.flatnonzero((branch == k) & confident)
+            if len(rows):
+                proba = model.predict_proba(X[rows])
+                decided = proba.max(axis=1) >= branch_threshold
+                codes[rows[decided]] = table[proba[decided].argmax(axis=1)]
+                level[rows] = 1
+        exit_fraction = float(np.mean(level == 0)) if len(X) else 0.0
+        return self.class_array[codes], level, exit_fraction
+
+
+def two_step_classifier(order, species, concentration, thresholds=(0.0, 0.0)):
+    """
+    Assemble the two-step classifier: the order model decides the order, and the samples of the
+    orders in species are passed on to the species model of their order.
+
+    Args:
+        order: The fitted order model.
+        species: A dict that maps an order, e.g. "Bacillales", to its fitted species model.
+        concentration: The concentration the models were trained on.
+        thresholds: The probability thresholds (order, species) of predict_cascade(), the default
+         is (0.0, 0.0).
+
+    Returns:
+        A HierarchicalClassifier whose classes are the organisms (and xBlank for "all").
+    """
+    return HierarchicalClassifier(order, class_names(ORDERS, concentration), species,
+                                  {name: class_names(ORDER_TO_SPECIES[name], concentration) for name in species},
+                                  class_names(ORGANISMS_WITH_BLANK, concentration), thresholds)
+
+
+def load_collapsed(path):
+    """
+    Load a .pkl model for predicting: its collapsed copy (see collapse_linear_models()) when there
+    is one at least as new as the .pkl, otherwise the model itself through load_model().
+    """
+    manifest = os.path.join(linear_path(path), MANIFEST)
+    if os.path.exists(manifest) and os.path.getmtime(manifest) >= os.path.getmtime(path):
+        return load_model(linear_path(path))
+    return load_model(path)
+
+
+def collapse_linear_models(root):
+    """
+    Collapse every linear pipeline (see is_linear_pipeline()) saved as .pkl under root into a
+    LinearPipeline, saved as an array store ending with LINEAR_SUFFIX next to it. A LinearPipeline
+    only predicts (no transform(), fit() or named_steps), so load_model() keeps loading the full
+    model, and the copy is only used through load_collapsed(), e.g. by the prediction server.
+
+    Args:
+        root: The folder to search for .pkl files.
+    """
+    for dirs, _, files in os.walk(root):
+        for file in sorted(files):
+            path = os.path.join(dirs, file)
+            if file.endswith(".pkl"):
+                with open(path, "rb") as f:
+                    model = pickle.load(f)
+                if is_linear_pipeline(model):
+                    save_model(LinearPipeline.from_pipeline(model), linear_path(path))
+                    print(f"{path} -> {linear_path(path)}")
+
+
+if __name__ == "__main__":
+    # the collapsed models must record the class as Utils.predict.LinearPipeline, not __main__
+    from Utils.predict import collapse_linear_models as collapse
+
+    collapse(sys.argv[1] if len(sys.argv) > 1 else ".")
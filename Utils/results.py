@@ -0,0 +1,202 @@
+import atexit
+import json
+import os
+import sqlite3
+from contextlib import contextmanager
+
+import pandas as pd
+
+STORE_NAME = ".results.sqlite"
+
+
+def default_columns():
+    """The columns of the accuracy tables, used when a table is created without column names."""
+    return (["number_of_pictures", "diameter", "concentration", "Accuracy_score", "Recall", "F1_score",
+             "Precision_score"] + [f"Score{i}" for i in range(1, 31)])
+
+
+class ResultsStore:
+    """
+    Append-only store of the rows of the evaluation tables.
+
+    insert() appends a row to a SQLite database, which is a single cheap transaction and is safe
+    when several processes write to the same store. The Excel tables are only written by export(),
+    which rebuilds every table with pending rows and replaces the file atomically, so the layout of
+    the tables stays the one create_table() produces. The store keeps every row it has exported and
+    the number of rows a table held before its first export, and a table is rebuilt from those first
+    rows followed by all the rows of the store, so an export that stops between replacing the file
+    and marking the rows as exported is simply done again, without appending anything twice. An
+    export holds the write lock of the database while it writes, so concurrent exports do not
+    interleave.
+
+    Args:
+        path: The path of the SQLite database.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS rows (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                         "table_path TEXT, sheet TEXT, columns TEXT, data TEXT, exported INTEGER DEFAULT 0)")
+            conn.execute("CREATE TABLE IF NOT EXISTS tables (table_path TEXT, sheet TEXT, base INTEGER, "
+                         "PRIMARY KEY (table_path, sheet))")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=60)
+
+    def insert(self, new_data, table_path, column_names=None, sheet="Sheet1"):
+        """
+        Store one row of a table until the next export().
+
+        Args:
+            new_data: The model evaluation parameters that need to be inserted are a fixed format list.
+            table_path: The path to the table.
+            column_names: The column name of the table, used if the table does not exist yet.
+            sheet: The inserted Sheet. Sheet1 is inserted by default.
+        """
+        data = json.dumps(list(new_data), default=lambda x: x.item())
+        with self._connect() as conn:
+            conn.execute("INSERT INTO rows (table_path, sheet, columns, data) VALUES (?, ?, ?, ?)",
+                         (os.path.abspath(table_path), sheet, json.dumps(column_names), data))
+
+    def export(self, table_path=None):
+        """
+        Write the pending rows into their Excel tables.
+
+        Args:
+            table_path: Only export the rows of this table, the default is None, which exports all.
+        """
+        conn = self._connect()
+        conn.isolation_level = None
+        try:
+            # the write lock is taken before the pending rows are read, so two processes never
+            # export at the same time, and a failed export leaves them pending
+            conn.execute("BEGIN IMMEDIATE")
+            query = "SELECT DISTINCT table_path, sheet FROM rows WHERE exported = 0"
+            params = ()
+            if table_path is not None:
+                query += " AND table_path = ?"
+                params = (os.path.abspath(table_path),)
+            for path, sheet in conn.execute(query, params).fetchall():
+                df = pd.read_excel(path, sheet_name=sheet, header=0, index_col=None) if os.path.exists(path) else None
+                base = conn.execute("SELECT base FROM tables WHERE table_path = ? AND sheet = ?",
+                                    (path, sheet)).fetchone()
+                if base is None:
+                    # the rows the table held before the store wrote into it, the ones it has exported
+                    # already are not counted, they are rebuilt from the store
+                    exported = conn.execute("SELECT COUNT(*) FROM rows WHERE table_path = ? AND sheet = ? AND "
+                                            "exported = 1", (path, sheet)).fetchone()[0]
+                    base = (max(0, len(df) - exported) if df is not None else 0,)
+                    conn.execute("INSERT INTO tables VALUES (?, ?, ?)", (path, sheet, base[0]))
+                    # it is committed before the table is replaced, so it is never counted again
+                    conn.execute("COMMIT")
+                    conn.execute("BEGIN IMMEDIATE")
+                rows = conn.execute("SELECT id, columns, data FROM rows WHERE table_path = ? AND sheet = ? ORDER BY id",
+                                    (path, sheet)).fetchall()
+                if df is None:
+                    df = pd.DataFrame(columns=json.loads(rows[0][1]) or default_columns())
+                new = pd.DataFrame([json.loads(data) for _, _, data in rows], columns=df.columns)
+                df = df.iloc[:base[0]]
+                df = new if df.empty else pd.concat([df, new], ignore_index=True)
+                tmp = os.path.join(os.path.dirname(path), f".{os.getpid()}.{os.path.basename(path)}")
+                df.to_excel(tmp, sheet_name=sheet, index=False)
+                os.replace(tmp, path)
+                conn.execute("UPDATE rows SET exported = 1 WHERE table_path = ? AND sheet = ? AND id <= ?",
+                             (path, sheet, rows[-1][0]))
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+
+_stores = {}
+_deferred = []
+
+
+def get_store(table_path):
+    """
+    Return the ResultsStore of the folder of a table, the pending rows of every store that is used
+    are exported when the interpreter exits.
+
+    Args:
+        table_path: The path to the table.
+
+    Returns:
+        The ResultsStore kept in STORE_NAME next to the table.
+    """
+    folder = os.path.dirname(os.path.abspath(table_path))
+    if folder not in _stores:
+        if not _stores:
+            atexit.register(export_all)
+        os.makedirs(folder, exist_ok=True)
+        _stores[folder] = ResultsStore(os.path.join(folder, STORE_NAME))
+    return _stores[folder]
+
+
+def export_all():
+    """Export the pending rows of every store used in this process."""
+    for store in _stores.values():
+        store.export()
+
+
+@contextmanager
+def deferred():
+    """
+    Collect the results written in the block by insert_row() and append_line() instead of storing
+    them, so that they can be stored by commit() once the work that produced them has succeeded.
+    The files written through output_path() are moved to their place by commit() as well, after
+    the rows and lines, so a file that marks the work as done never exists without its results.
+
+    Yields:
+        The list of the collected results, it can be pickled to another process.
+    """
+    results = []
+    _deferred.append(results)
+    try:
+        yield results
+    finally:
+        _deferred.pop()
+
+
+def insert_row(new_data, table_path, column_names=None, sheet="Sheet1"):
+    """Insert a row into the store of its table, see ResultsStore.insert(), or collect it, see deferred()."""
+    if _deferred:
+        _deferred[-1].append(("row", table_path, list(new_data), column_names, sheet))
+    else:
+        get_store(table_path).insert(new_data, table_path, column_names, sheet)
+
+
+def append_line(path, line):
+    """Append a line to a text file, or collect it, see deferred()."""
+    if _deferred:
+        _deferred[-1].append(("line", path, line))
+    else:
+        with open(path, "a") as f:
+            f.write(line + "\n")
+
+
+def output_path(path):
+    """
+    The path to write the file at path to: path itself, or, in a deferred() block, a temporary
+    file next to it that commit() renames to path.
+    """
+    if not _deferred:
+        return path
+    tmp = os.path.join(os.path.dirname(path), f".{os.getpid()}.{os.path.basename(path)}")
+    _deferred[-1].append(("file", path, tmp))
+    return tmp
+
+
+def commit(results):
+    """Store the results collected by deferred(), the files of output_path() last."""
+    for kind, path, *args in results:
+        if kind == "row":
+            insert_row(args[0], path, *args[1:])
+        elif kind == "line":
+            append_line(path, args[0])
+    for kind, path, *args in results:
+        if kind == "file":
+            os.replace(args[0], path)
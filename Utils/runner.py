@@ -0,0 +1,420 @@
+"""
+Declarative experiment runner for the model families under Models.
+
+Every family (nine_single, Dichotomies_merged, the order and species models of the two-step
+classifier, ... for PCA_LDA and RF) is described by one entry of a JSON config, by default
+Models/experiments.json:
+
+    {
+        "name": "PCA_LDA/nine_single",         the name used by --only
+        "folder": "Models/PCA_LDA/nine_single", model/, params/, image/, table/, ... are in it
+        "identifier": "nine_single",            the prefix of every file name
+        "estimator": "kernel_pca_lda",          "pca_lda", "kernel_pca_lda" or "random_forest"
+        "data": "Data/split",                   holds train/ and test/, may contain {target}
+        "split": "Data/split.csv",              optional, a split manifest of the image store "data",
+                                                may contain {target}, see Utils.splits
+        "view": ["dichotomy", "{target}"],      optional with "split", a view of Utils.splits.VIEWS
+        "model_type": "Single",                 "Single", "Merged" or "VirtualMerged"
+        "targets": null,                        a list, or the name of a list in Utils.names
+        "concentrations": ["10^4", "10^5", "10^6", "all"],
+        "confusion": {"rotation": 45},          keyword arguments of confusionPainting()
+        "outputs": ["scatter", "variance"],     any of "scatter", "variance", "auroc", "probability"
+        "accuracy_table": "{identifier}_Accuracy.xlsx",
+        "number_of_pictures": 3
+    }
+
+The parameters of a model are read from params/<name>.json (random_forest) or
+params/<name>_pca.json and params/<name>_lda.json (the pipelines).
+
+Two estimators are not trained but assembled from the saved models of model/ and evaluated on the
+test data, in both modes (ASSEMBLED):
+
+    "two_step"      the two-step classifier of the order model <identifier>_<concentration> and
+                    the species models <identifier>_<order>_<concentration> of "orders". The
+                    output "cascade" also evaluates predict_cascade() with "cascade_thresholds".
+    "all_targets"   the one-vs-rest models <identifier>_<member>_<concentration> of the "members"
+                    (a list, or the name of a list in Utils.names) scored at once. The label of each
+                    member in its model is read from the train folder of "members_data".
+
+The files are named as the scripts of the families name them, and the same png, csv, txt and xlsx
+outputs are produced; the scripts of the families only call run_families(). plan() expands all the
+families into one list of Experiment, so the runner shares what the families have in common: every
+dataset is read once, the folds of the cross validation are split once per test set, and a model
+(or its cross validation) that several experiments describe identically is fitted once. With
+--workers the experiments are run by Utils.scheduler instead, on a pool of processes that resumes
+an interrupted training and stores the results of the experiments that succeeded only.
+
+Usage:
+    python -m Utils.runner [config] [--mode train|result] [--only PCA_LDA/nine_single ...] [--workers 4]
+"""
+import argparse
+import copy
+import json
+import os
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+from sklearn.decomposition import PCA, KernelPCA
+from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.metrics import roc_auc_score, average_precision_score
+from sklearn.pipeline import Pipeline
+
+from Utils import names
+from Utils.display import confusionPainting, scatter
+from Utils.evaluate import model_metrics, cross_validation, cv_splits
+from Utils.io import save_classes, save_model, load_model, load_param, insert_into_table, export_tables
+from Utils.names import CONCENTRATIONS, class_names, name_to_abbr
+from Utils.predict import load_all_targets, target_label, two_step_classifier
+from Utils.results import append_line
+from Utils.scheduler import Task, concentrations_of, load_dataset, run_tasks
+from Utils.splits import load_split, view_of
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIG = os.path.join(REPO_ROOT, "Models", "experiments.json")
+SCORE_COLUMNS = ["target", "number_of_pictures", "diameter", "concentration"] + [f"Score{i}" for i in range(1, 31)]
+AUROC_AUPR_COLUMNS = ["target", "number_of_pictures", "diameter", "concentration", "AUROC", "AUPR",
+                      "Accuracy_score", "Recall", "F1_score", "Precision_score"]
+TWO_STEP_COLUMNS = ["concentration", "Accuracy", "Recall", "F1", "Precision"]
+CASCADE_COLUMNS = ["concentration", "order_threshold", "species_threshold", "exit_fraction", "final_fraction",
+                   "final_accuracy"]
+ALL_TARGETS_COLUMNS = ["number_of_pictures", "diameter", "concentration", "Accuracy_score", "Recall", "F1_score",
+                       "Precision_score"]
+ASSEMBLED = ("two_step", "all_targets")
+
+
+def build_estimator(estimator, param_path, n_jobs=None):
+    """
+    Build an unfitted model from its parameter files.
+
+    Args:
+        estimator: "pca_lda", "kernel_pca_lda" or "random_forest".
+        param_path: The path of the parameter files without the suffix, "_pca.json" and "_lda.json"
+         are appended for the pipelines and ".json" for the RandomForest.
+        n_jobs: The number of cores the RandomForest is fitted with, instead of the n_jobs of its
+         parameters, e.g. the share of a worker of the scheduler. The default is None, which keeps it.
+
+    Returns:
+        model: The unfitted model.
+        params: The parameters, used to recognise identical models.
+    """
+    if estimator == "random_forest":
+        params = load_param(f"{param_path}.json")
+        model = RandomForestClassifier(**params)
+        return (model if n_jobs is None else model.set_params(n_jobs=n_jobs)), params
+    params = {"pca": load_param(f"{param_path}_pca.json"), "lda": load_param(f"{param_path}_lda.json")}
+    projection = PCA if estimator == "pca_lda" else KernelPCA
+    return Pipeline([
+        ('pca', projection(**params["pca"])),
+        ('lda', LinearDiscriminantAnalysis(**params["lda"]))
+    ]), params
+
+
+class Experiment:
+    """
+    One model of a family: a target (or none) at one concentration.
+
+    Args:
+        spec: The entry of the family in the config.
+        target: The target, None for the families without targets.
+        concentration: The concentration.
+    """
+
+    def __init__(self, spec, target, concentration):
+        self.spec = spec
+        self.target = target
+        self.concentration = concentration
+        self.folder = os.path.join(REPO_ROOT, spec["folder"])
+        self.identifier = spec["identifier"]
+        self.name = "_".join(x for x in (self.identifier, target, concentration) if x is not None)
+        self.data = os.path.join(REPO_ROOT, spec["data"].format(target=target))
+        self.split = spec.get("split")
+        if self.split is not None:
+            self.split = os.path.join(REPO_ROOT, self.split.format(target=target))
+        self.view = tuple(x.format(target=target) for x in spec.get("view", ()))
+        self.model_type = spec["model_type"]
+        self.outputs = spec.get("outputs", [])
+        self.trained = spec["estimator"] not in ASSEMBLED
+
+    def path(self, kind, file):
+        """The path of an output file in the folder of the family, its directory is created."""
+        os.makedirs(os.path.join(self.folder, kind), exist_ok=True)
+        return os.path.join(self.folder, kind, file)
+
+    def table(self, template):
+        return self.path("table", template.format(identifier=self.identifier, target=self.target))
+
+    def param_path(self):
+        """The path of the parameter files of the model, without the suffix, see build_estimator()."""
+        return os.path.join(self.folder, "params", self.name)
+
+    def class_names(self):
+        """
+        The names of the classes of the model, in the order of its labels, read from the folders of
+        the training data (or its split manifest) without reading the images.
+        """
+        if self.split is None:
+            organisms = os.listdir(os.path.join(self.data, "train"))
+        else:
+            manifest = load_split(self.split)
+            organisms, view = manifest.loc[manifest["fold"] == "train", "organism"], view_of(*self.view)
+            organisms = sorted(set(organisms.map(view).dropna() if view is not None else organisms))
+        return class_names(organisms, self.concentration)
+
+    def dataset_args(self, fold):
+        """The arguments of load_dataset() for the "train" or the "test" data, the folder or the fold of the split."""
+        if self.split is None:
+            return os.path.join(self.data, fold), self.model_type
+        return self.data, self.model_type, 225, (self.split, fold, self.view)
+
+
+def plan(config, only=None):
+    """
+    Expand the families of the config into experiments.
+
+    Args:
+        config: The list of family entries.
+        only: The names of the families to run, the default is None, which runs all of them.
+
+    Returns:
+        A list of Experiment, grouped by their test data so that the datasets are used one after another.
+    """
+    experiments = []
+    for spec in config:
+        if only and spec["name"] not in only:
+            continue
+        targets = spec.get("targets")
+        if isinstance(targets, str):
+            targets = getattr(names, targets)
+        for target in targets or [None]:
+            for concentration in spec.get("concentrations", CONCENTRATIONS):
+                if target is not None and concentration not in concentrations_of(target):
+                    continue
+                experiments.append(Experiment(spec, target, concentration))
+    return sorted(experiments, key=lambda e: str(e.dataset_args("test")))
+
+
+class Runner:
+    """
+    Run experiments, sharing datasets, folds, fitted models and cross validations between them.
+
+    Args:
+        mode: "train" fits the models from their parameters and saves them, "result" loads the
+         saved models, as the *_generate_result scripts do.
+        n_jobs: The number of folds fitted in parallel, the default is -1 (all cores).
+    """
+
+    def __init__(self, mode="train", n_jobs=-1):
+        self.mode = mode
+        self.n_jobs = n_jobs
+        self.splits = {}
+        self.models = {}
+        self.cv = {}
+
+    def data(self, experiment):
+        X_train, y_train = load_dataset(*experiment.dataset_args("train")).subset(experiment.concentration)
+        X_test, y_test = load_dataset(*experiment.dataset_args("test")).subset(experiment.concentration)
+        return X_train, y_train, X_test, y_test
+
+    def model(self, experiment, X_train, y_train):
+        """Fit or load the model of an experiment, once for all the experiments that describe it identically."""
+        if self.mode == "result":
+            path = experiment.path("model", f"{experiment.name}.pkl")
+            key = ("load", path)
+            if key not in self.models:
+                self.models[key] = load_model(path)
+            return key, self.models[key]
+
+        model, params = build_estimator(experiment.spec["estimator"], experiment.param_path(), self.n_jobs)
+        key = (experiment.spec["estimator"], json.dumps(params, sort_keys=True), experiment.dataset_args("train"),
+               experiment.concentration)
+        if key not in self.models:
+            self.models[key] = model.fit(X_train, y_train)
+        return key, self.models[key]
+
+    def cross_validation(self, key, model, experiment, X_test, y_test):
+        """Cross validate the model on the test data, once per model and test set."""
+        data_key = (experiment.dataset_args("test"), experiment.concentration)
+        if data_key not in self.splits:
+            self.splits[data_key] = cv_splits(y_test)
+        if (key, data_key) not in self.cv:
+            scoring = ("accuracy", "roc_auc", "average_precision") if len(np.unique(y_test)) == 2 else ("accuracy",)
+            self.cv[key, data_key], _ = cross_validation(model, X_test, y_test, scoring, n_jobs=self.n_jobs,
+                                                         splits=self.splits[data_key])
+        return self.cv[key, data_key]
+
+    def run_one(self, experiment):
+        if not experiment.trained:
+            return self.run_assembled(experiment)
+        spec = experiment.spec
+        X_train, y_train, X_test, y_test = self.data(experiment)
+        classes = class_names(load_dataset(*experiment.dataset_args("train")).organisms, experiment.concentration)
+        labels = [name_to_abbr.get(x, x) for x in classes]
+        print(experiment.name, "X_train:", X_train.shape, "X_test:", X_test.shape)
+
+        key, model = self.model(experiment, X_train, y_train)
+
+        # confusion matrix
+        y_pred = model.predict(X_test)
+        confusionPainting(y_pred, y_test, labels, plt.cm.Reds, **spec.get("confusion", {}),
+                          output=experiment.path("image", f"{experiment.name}.png"))
+
+        # LDA scatter and variance
+        if "scatter" in experiment.outputs:
+            X = model.transform(np.concatenate((X_train, X_test)))
+            scatter(np.concatenate((y_train, y_test)), X, output=experiment.path("scatter", f"{experiment.name}.csv"))
+        if "variance" in experiment.outputs:
+            stem = "_".join(x for x in (experiment.identifier, experiment.target) if x is not None)
+            v = model.named_steps["lda"].explained_variance_ratio_
+            append_line(experiment.path("variance", f"{stem}.txt"), f"{experiment.name}\t{v[0]}\t{v[1]}")
+
+        # the probabilities used to draw the ROC curves
+        if "probability" in experiment.outputs:
+            proba = model.predict_proba(X_test)
+            df = pd.DataFrame(np.hstack((y_test.reshape(-1, 1), proba[:, 0].reshape(-1, 1))))
+            df.iloc[:, 0] = df.iloc[:, 0].astype(np.uint8)
+            df.to_csv(experiment.path("probability", f"{experiment.name}.csv"), index=False, header=False)
+
+        # model metrics
+        Accuracy_score, Recall, F1_score, Precision_score = model_metrics(y_test, y_pred)
+        cv_scores = self.cross_validation(key, model, experiment, X_test, y_test)
+        data = [3, 3, experiment.concentration, Accuracy_score, Recall, F1_score, Precision_score] + list(
+            cv_scores["accuracy"])
+        insert_into_table(data, experiment.table(spec["accuracy_table"]))
+
+        if "auroc" in experiment.outputs:
+            y_probs = model.predict_proba(X_test)[:, 1]
+            AUROC = roc_auc_score(y_test, y_probs)
+            AUPR = average_precision_score(y_test, y_probs)
+            data = [experiment.target, spec.get("number_of_pictures", 3), 3, experiment.concentration, AUROC, AUPR,
+                    Accuracy_score, Recall, F1_score, Precision_score]
+            insert_into_table(data, experiment.table("{identifier}_AUROC_AUPR.xlsx"), AUROC_AUPR_COLUMNS)
+            prefix = [experiment.target, 3, 3, experiment.concentration]
+            insert_into_table(prefix + cv_scores["roc_auc"], experiment.table("{identifier}_AUROC.xlsx"), SCORE_COLUMNS)
+            insert_into_table(prefix + cv_scores["average_precision"], experiment.table("{identifier}_AUPR.xlsx"),
+                              SCORE_COLUMNS)
+
+        # the model is saved last, it marks the experiment as done for the scheduler
+        if self.mode == "train":
+            if spec["estimator"] == "random_forest":
+                # the saved model predicts with the n_jobs of its parameters, not the one it was fitted with
+                model = copy.copy(model).set_params(n_jobs=load_param(f"{experiment.param_path()}.json").get("n_jobs"))
+            save_classes(classes, experiment.path("model", f"{experiment.name}.pkl"))
+            save_model(model, experiment.path("model", f"{experiment.name}.pkl"))
+
+    def run_assembled(self, experiment):
+        """Assemble the model of a "two_step" or "all_targets" experiment from model/ and evaluate it."""
+        spec = experiment.spec
+        concentration = experiment.concentration
+        test_set = load_dataset(*experiment.dataset_args("test"))
+        X_test, y_test = test_set.subset(concentration)
+        # the names of the true classes, the order of the folders is the one of the labels
+        y_test = np.array(class_names(test_set.organisms, concentration))[y_test]
+        print(experiment.name, "X_test:", X_test.shape)
+
+        model_dir = os.path.join(experiment.folder, "model")
+        if spec["estimator"] == "all_targets":
+            members = spec["members"]
+            members = getattr(names, members) if isinstance(members, str) else members
+            positive = {member: target_label(os.path.join(REPO_ROOT, spec["members_data"].format(target=member),
+                                                          "train"), member, concentration)
+                        for member in members}
+            model = load_all_targets(model_dir, experiment.identifier, concentration, members, positive)
+            keep = np.isin(y_test, members)
+            y_pred = model.predict(X_test[keep])
+            Accuracy, Recall, F1_score, Precision_score = model_metrics(y_test[keep], y_pred)
+            insert_into_table([3, 3, concentration, Accuracy, Recall, F1_score, Precision_score],
+                              experiment.table(spec["accuracy_table"]), ALL_TARGETS_COLUMNS)
+            return
+
+        def load(name):
+            return load_model(os.path.join(model_dir, f"{name}.pkl"))
+
+        model = two_step_classifier(load(experiment.name),
+                                    {order: load(f"{experiment.identifier}_{order}_{concentration}")
+                                     for order in spec["orders"]}, concentration)
+        labels = [name_to_abbr.get(x, x) for x in model.classes]
+        y_pred = model.predict(X_test)
+        confusionPainting(y_test, y_pred, labels, plt.cm.Reds, **spec.get("confusion", {}),
+                          output=experiment.path("image", f"{experiment.name}.png"))
+        Accuracy, Recall, F1_score, Precision_score = model_metrics(y_test, y_pred)
+        insert_into_table([concentration, Accuracy, Recall, F1_score, Precision_score],
+                          experiment.table(spec["accuracy_table"]), TWO_STEP_COLUMNS)
+
+        # confidence-gated prediction: the samples that stop early keep the name of their order
+        if "cascade" in experiment.outputs:
+            thresholds = tuple(spec["cascade_thresholds"])
+            y_cascade, _, exit_fraction = model.predict_cascade(X_test, thresholds)
+            final = np.isin(y_cascade, model.classes)
+            accuracy_final = float(np.mean(y_cascade[final] == y_test[final])) if final.any() else 0.0
+            insert_into_table([concentration, *thresholds, exit_fraction, float(final.mean()), accuracy_final],
+                              experiment.table("{identifier}_cascade.xlsx"), CASCADE_COLUMNS)
+
+    def run(self, experiments):
+        for experiment in experiments:
+            self.run_one(experiment)
+        export_tables()
+
+
+_runners = {}
+
+
+def run_experiment(spec, target, concentration, mode, n_jobs=-1):
+    """Run one experiment in a worker of the scheduler, with the Runner of the process."""
+    if mode not in _runners:
+        _runners[mode] = Runner(mode, n_jobs)
+    _runners[mode].run_one(Experiment(spec, target, concentration))
+
+
+def run_parallel(experiments, mode="train", n_workers=None):
+    """
+    Run the experiments as the tasks of Utils.scheduler.run_tasks(). In train mode an experiment
+    whose model is saved is skipped, and the rows of an experiment are only stored when it succeeds.
+
+    Args:
+        experiments: A list of Experiment.
+        mode: "train" or "result", see Runner.
+        n_workers: The number of processes, the default is None, see run_tasks().
+    """
+    tasks = []
+    for e in experiments:
+        outputs = [e.path("model", f"{e.name}.pkl")] if mode == "train" and e.trained else []
+        datasets = [e.dataset_args("train")] if e.trained else []
+        tasks.append(Task(f"{e.spec['name']}/{e.name}", run_experiment, (e.spec, e.target, e.concentration, mode),
+                          outputs=outputs, datasets=datasets + [e.dataset_args("test")]))
+    try:
+        run_tasks(tasks, n_workers)
+    finally:
+        export_tables()
+
+
+def run_families(only=None, mode="train", n_jobs=-1, workers=1, config=CONFIG):
+    """
+    Run the families of a config, the entry point of the scripts of the families.
+
+    Args:
+        only: The names of the families to run, the default is None, which runs all of them.
+        mode: "train" or "result", see Runner.
+        n_jobs: The number of folds fitted in parallel by Runner, the default is -1 (all cores).
+        workers: The number of processes of run_parallel(), None uses all the cores. The default is
+         1, which runs the experiments one after another in this process, sharing the fitted models.
+        config: The path of the config, the default is CONFIG.
+    """
+    with open(config, "r") as f:
+        experiments = plan(json.load(f), only)
+    if workers == 1:
+        Runner(mode, n_jobs).run(experiments)
+    else:
+        run_parallel(experiments, mode, workers)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the experiments described by a config.")
+    parser.add_argument("config", nargs="?", default=CONFIG)
+    parser.add_argument("--mode", choices=["train", "result"], default="train")
+    parser.add_argument("--only", nargs="*", default=None)
+    parser.add_argument("--n_jobs", type=int, default=-1)
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+    run_families(args.only, args.mode, args.n_jobs, args.workers, args.config)
@@ -0,0 +1,154 @@
+"""
+Parallel scheduler for the target x concentration training grid.
+
+Every combination of a target (an organism or an order) and a concentration is an independent
+Task. run_tasks() skips the tasks whose outputs already exist, so an interrupted run resumes where
+it stopped, and runs the others on a pool of processes. The rows a task inserts into the tables and
+the lines it appends to text files (Utils.results.insert_row() and append_line()) are collected
+while it runs and handed to the parent, which stores them only when the task has succeeded, so a
+failed task leaves nothing behind and its re-run does not duplicate anything. The model a task
+saves (Utils.io.save_model()) marks it as done, so the parent only renames it into place after it
+has stored the rows and lines of the task, see Utils.results.output_path(). The cores of
+cpu_budget are shared between the processes: every task gets n_jobs = cpu_budget // n_workers for
+its own parallel work (the folds of cross_validation(), the trees of a RandomForest) and the BLAS
+threads of every process are limited to the same number, so nested parallelism does not
+oversubscribe the machine.
+
+The processes read the histograms through load_dataset(), which keeps every Dataset a process has
+loaded. The datasets the tasks declare are loaded by the parent before the pool is started, so the
+FeatureCache of every folder is built once and the workers inherit the datasets instead of reading
+them again. The histograms themselves come from the FeatureCache, whose memory-mapped matrices are
+shared by all the processes through the page cache.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
+
+from threadpoolctl import threadpool_limits
+
+from Utils.dataset import Dataset, VirtualMergedDataset
+from Utils.names import BLANK, CONCENTRATIONS
+from Utils.results import commit, deferred, get_store
+from Utils.splits import SplitDataset, view_of
+
+
+class Task:
+    """
+    One cell of the training grid.
+
+    Args:
+        name: The name of the task, used in the log.
+        func: A module-level function, called as func(*args, n_jobs=n_jobs).
+        args: The arguments of func.
+        outputs: The files the task writes, the task is skipped when all of them exist.
+        tables: The Excel tables the task inserts rows into, they are exported when the run ends.
+        datasets: The arguments of load_dataset() of the datasets the task reads, e.g. (path,
+         model_type), they are loaded before the pool is started.
+    """
+
+    def __init__(self, name, func, args, outputs=(), tables=(), datasets=()):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.outputs = list(outputs)
+        self.tables = list(tables)
+        self.datasets = list(datasets)
+
+    def done(self):
+        """Whether all the outputs of the task exist."""
+        return bool(self.outputs) and all(os.path.exists(output) for output in self.outputs)
+
+
+def concentrations_of(target):
+    """The concentrations a target is trained on, xBlank only exists in "all"."""
+    return ["all"] if target == BLANK else list(CONCENTRATIONS)
+
+
+@lru_cache(maxsize=None)
+def load_dataset(path, model_type, feature_num=225, split=None):
+    """
+    Return the Dataset of a folder, read once per process.
+
+    Args:
+        path: the path of folder that contains the images
+        model_type: The form of data accepted by the model. It can be "Single" or "Merged", or
+         "VirtualMerged" for the "Merged" features gathered from the single-diameter images under
+         path, see VirtualMergedDataset.
+        feature_num: The number of gray values (features) for each gray histogram, the default is 225.
+        split: A tuple (manifest, fold, view) to read one fold of a split manifest of the image
+         store path instead, see SplitDataset. view is a tuple (name, *args) of Utils.splits.view_of(),
+         () keeps the organisms. The default is None.
+
+    Returns:
+        The Dataset, built with the FeatureCache.
+    """
+    if split is not None:
+        manifest, fold, view = split
+        return SplitDataset(path, manifest, fold, model_type, view_of(*view), feature_num)
+    if model_type == "VirtualMerged":
+        return VirtualMergedDataset(path, feature_num)
+    return Dataset(path, model_type, feature_num)
+
+
+def _init_worker(n_jobs):
+    os.environ["OMP_NUM_THREADS"] = str(n_jobs)
+    threadpool_limits(n_jobs)
+
+
+def _run(task, n_jobs):
+    with deferred() as results:
+        task.func(*task.args, n_jobs=n_jobs)
+    return results
+
+
+def run_tasks(tasks, n_workers=None, cpu_budget=None):
+    """
+    Run the tasks that are not done yet on a pool of processes.
+
+    Args:
+        tasks: A list of Task.
+        n_workers: The number of processes, the default is min(number of tasks, cpu_budget).
+        cpu_budget: The number of cores to use, the default is all of them.
+    """
+    pending = [task for task in tasks if not task.done()]
+    for task in tasks:
+        if task not in pending:
+            print(f"skip {task.name}, its outputs exist")
+    if not pending:
+        return
+    cpu_budget = cpu_budget or os.cpu_count()
+    n_workers = max(1, min(n_workers or cpu_budget, len(pending), cpu_budget))
+    n_jobs = max(1, cpu_budget // n_workers)
+    print(f"{len(pending)} tasks on {n_workers} processes with n_jobs={n_jobs}")
+    for spec in dict.fromkeys(spec for task in pending for spec in task.datasets):
+        load_dataset(*spec)
+
+    succeeded, failed = [], []
+
+    def finish(task, get_results):
+        try:
+            results = get_results()
+        except Exception as e:
+            print(f"failed {task.name}: {type(e).__name__}: {e}")
+            failed.append(task.name)
+            return
+        commit(results)
+        succeeded.append(task)
+        print(f"done {task.name}")
+
+    try:
+        if n_workers == 1:
+            with threadpool_limits(n_jobs):
+                for task in pending:
+                    finish(task, lambda: _run(task, n_jobs))
+        else:
+            with ProcessPoolExecutor(n_workers, initializer=_init_worker, initargs=(n_jobs,)) as pool:
+                futures = {pool.submit(_run, task, n_jobs): task for task in pending}
+                for future in as_completed(futures):
+                    finish(futures[future], future.result)
+    finally:
+        # the rows of the succeeded tasks are only in the ResultsStore, the tables are written once here
+        for table in sorted({table for task in succeeded for table in task.tables}):
+            get_store(table).export(table)
+    if failed:
+        raise RuntimeError(f"{len(failed)} tasks failed: {', '.join(failed)}")
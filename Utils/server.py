@@ -0,0 +1,269 @@
+"""
+Resident prediction server that keeps every trained model in memory.
+
+At startup all the models under Models/<algorithm>/<family>/model are loaded once (nine_single,
+nine_merged, Dichotomies_*, the order and species models of the two-step classifier, for RF and
+PCA_LDA), together with the two-step classifiers assembled from the two_steps_result models and
+the "all_targets" predictors that score all nine Dichotomies models of a concentration at once.
+Requests are answered over HTTP on a local port or a Unix socket:
+
+    GET  /models              the names of the models and the features they expect
+    POST /predict/<model>     body: one TIFF image (Content-Type: image/tiff), or JSON
+                              {"histograms": [[...], ...]} with precomputed histograms
+
+The classes of a model are named by the class names saved next to it (Utils.io.save_classes()),
+or, for the models saved without them, by the training data of its experiment in the config of
+Utils.runner. A model whose classes cannot be named is not served.
+
+The answer is JSON {"classes": [...], "labels": [...], "probabilities": [[...], ...]}, or
+{"error": ...} with status 400 for a malformed request and 500 when the model fails. Concurrent
+requests for the same model are gathered into one micro-batch, so the model is called once for
+all of them.
+
+Usage:
+    python -m Utils.server [--port 8000 | --socket /tmp/microbe.sock] [--models Models] [--config experiments.json]
+"""
+import argparse
+import glob
+import json
+import os
+import queue
+import socketserver
+import threading
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+
+from Utils.features import batch_histograms
+from Utils.io import load_classes, load_model
+from Utils.model_store import MODEL_SUFFIX
+from Utils.names import ORGANISMS
+from Utils.predict import AllTargetsPredictor, load_collapsed, two_step_classifier
+from Utils.runner import CONFIG, plan
+
+MODELS_ROOT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Models")
+FEATURE_NUM = 225
+
+
+def labels_of(path, experiment=None):
+    """
+    The class names of the labels of a saved model, names[label] being the name of a label of its
+    classes_, see Utils.io.save_classes().
+
+    Args:
+        path: The path of the model.
+        experiment: The Experiment of Utils.runner that trains the model, used when no names were
+         saved with the model. The default is None.
+
+    Returns:
+        The names, or None if they are unknown.
+    """
+    names = load_classes(path)
+    if names is None and experiment is not None:
+        try:
+            names = experiment.class_names()
+        except FileNotFoundError:
+            pass
+    return names
+
+
+def model_type_of(family):
+    """The form of data a model of the family is trained on, "Single" or "Merged"."""
+    return "Single" if family.endswith("single") else "Merged"
+
+
+def load_registry(root=MODELS_ROOT, config=CONFIG):
+    """
+    Load every model under root. A .pkl model is replaced by its collapsed LinearPipeline when
+    there is an up-to-date one, see Utils.predict.load_collapsed().
+
+    Args:
+        root: The Models folder, the default is MODELS_ROOT.
+        config: The config of Utils.runner, which names the classes of the models saved without
+         their class names. The default is CONFIG.
+
+    Returns:
+        A dict that maps "<algorithm>/<family>/<name>" to a tuple (model, class names, model_type).
+    """
+    experiments = {}
+    if os.path.exists(config):
+        with open(config, "r") as f:
+            for experiment in plan(json.load(f)):
+                algorithm, family = os.path.normpath(experiment.spec["folder"]).split(os.sep)[-2:]
+                experiments[f"{algorithm}/{family}/{experiment.name}"] = experiment
+    registry, labels = {}, {}
+    for path in sorted(glob.glob(os.path.join(root, "*", "*", "model", "*"))):
+        stem, ext = os.path.splitext(os.path.basename(path))
+        if ext not in (".pkl", MODEL_SUFFIX):
+            continue
+        if ext == MODEL_SUFFIX and os.path.exists(os.path.splitext(path)[0] + ".pkl"):
+            # loaded through its .pkl, which uses the store when it is up to date
+            continue
+        algorithm, family = path.split(os.sep)[-4:-2]
+        key = f"{algorithm}/{family}/{stem}"
+        if key in registry:
+            continue
+        labels[key] = labels_of(path, experiments.get(key))
+        if labels[key] is None:
+            print(f"warning: the classes of {path} are unknown, it is not served")
+            continue
+        model = load_collapsed(path) if ext == ".pkl" else load_model(path)
+        registry[key] = (model, [labels[key][label] for label in model.classes_], model_type_of(family))
+
+    for algorithm in ("PCA_LDA", "RF"):
+        for concentration in ("10^4", "10^5", "10^6", "all"):
+            prefix = f"{algorithm}/two_steps_result/order_merged"
+            keys = [f"{prefix}_{concentration}", f"{prefix}_Bacillales_{concentration}",
+                    f"{prefix}_Enterobacteriales_{concentration}"]
+            if all(key in registry for key in keys):
+                model = two_step_classifier(registry[keys[0]][0], {"Bacillales": registry[keys[1]][0],
+                                                                   "Enterobacteriales": registry[keys[2]][0]},
+                                            concentration)
+                registry[f"{algorithm}/two_steps_result/two_step_{concentration}"] = (model, model.classes, "Merged")
+
+            for family in ("Dichotomies_merged", "Dichotomies_single"):
+                keys = {target: f"{algorithm}/{family}/{family}_{target}_{concentration}" for target in ORGANISMS}
+                if all(key in registry for key in keys.values()):
+                    model = AllTargetsPredictor({target: registry[key][0] for target, key in keys.items()},
+                                                {target: labels[key].index(target) for target, key in keys.items()})
+                    registry[f"{algorithm}/{family}/all_targets_{concentration}"] = (model, ORGANISMS,
+                                                                                     model_type_of(family))
+    return registry
+
+
+class MicroBatcher:
+    """
+    Gather the requests for one model that arrive within max_delay seconds into one batch.
+
+    Args:
+        model: The fitted model, it must have predict_proba().
+        max_batch: The largest number of samples in a batch, the default is 256.
+        max_delay: The longest time in seconds a request waits for others, the default is 0.002.
+    """
+
+    def __init__(self, model, max_batch=256, max_delay=0.002):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.requests = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def predict_proba(self, X):
+        """Queue the samples and wait for their probabilities."""
+        future = Future()
+        self.requests.put((X, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            batch = [self.requests.get()]
+            size = len(batch[0][0])
+            try:
+                while size < self.max_batch:
+                    X, future = self.requests.get(timeout=self.max_delay)
+                    batch.append((X, future))
+                    size += len(X)
+            except queue.Empty:
+                pass
+            try:
+                proba = self.model.predict_proba(np.vstack([X for X, _ in batch]))
+                start = 0
+                for X, future in batch:
+                    future.set_result(proba[start:start + len(X)])
+                    start += len(X)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+
+
+def decode_tiff(body, model_type):
+    """Turn the bytes of a TIFF image into the "Single" or "Merged" histogram of a model."""
+    img = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+    if img is None:
+        raise ValueError("The body is not an image.")
+    img = cv2.resize(img, (256, 256))
+    return batch_histograms(img[np.newaxis], model_type, FEATURE_NUM)
+
+
+def make_handler(registry, batchers):
+    """Build the request handler class serving the given models."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def address_string(self):
+            return self.client_address[0] if self.client_address else "unix"
+
+        def _reply(self, code, content):
+            body = json.dumps(content).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != "/models":
+                return self._reply(404, {"error": f"unknown path {self.path}"})
+            self._reply(200, {key: {"n_features": model.n_features_in_, "classes": classes, "model_type": model_type}
+                              for key, (model, classes, model_type) in registry.items()})
+
+        def do_POST(self):
+            key = self.path[len("/predict/"):] if self.path.startswith("/predict/") else None
+            if key not in registry:
+                return self._reply(404, {"error": f"unknown model {key}"})
+            model, classes, model_type = registry[key]
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            try:
+                if self.headers.get("Content-Type", "").startswith("application/json"):
+                    X = np.asarray(json.loads(body)["histograms"], dtype=np.float64)
+                else:
+                    X = decode_tiff(body, model_type)
+                if X.ndim != 2 or X.shape[1] != model.n_features_in_:
+                    raise ValueError(f"expected histograms with {model.n_features_in_} features")
+                proba = batchers[key].predict_proba(X)
+                labels = [classes[i] for i in proba.argmax(axis=1)]
+            except (ValueError, KeyError) as e:
+                return self._reply(400, {"error": str(e)})
+            except Exception as e:
+                return self._reply(500, {"error": f"{type(e).__name__}: {e}"})
+            self._reply(200, {"classes": classes, "labels": labels, "probabilities": proba.tolist()})
+
+    return Handler
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(port=8000, socket_path=None, root=MODELS_ROOT, config=CONFIG):
+    """
+    Load the models and answer requests until interrupted.
+
+    Args:
+        port: The local TCP port, the default is 8000.
+        socket_path: If given, listen on this Unix socket instead of the TCP port.
+        root: The Models folder, the default is MODELS_ROOT.
+        config: The config of Utils.runner, see load_registry(). The default is CONFIG.
+    """
+    registry = load_registry(root, config)
+    batchers = {key: MicroBatcher(model) for key, (model, _, _) in registry.items()}
+    handler = make_handler(registry, batchers)
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, handler)
+    else:
+        server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    print(f"{len(registry)} models loaded, listening on {socket_path or f'127.0.0.1:{port}'}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the trained models.")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--socket", default=None)
+    parser.add_argument("--models", default=MODELS_ROOT)
+    parser.add_argument("--config", default=CONFIG)
+    args = parser.parse_args()
+    serve(args.port, args.socket, args.models, args.config)
@@ -0,0 +1,272 @@
+"""
+Seeded train/test splits stored as manifests, instead of copies of the images.
+
+"split dataset.py" used to copy every image into a train/ and a test/ tree, and the
+split_Dichotomies_*, split_by_order and split_in_<order> trees copied them again with other folder
+names. A split is now a manifest, a csv with the path of every image relative to one canonical
+image store, its organism and its fold. make_split() draws it reproducibly from a seed, and
+SplitDataset reads one fold of it straight from the store, with the histograms of the FeatureCache
+of the store, which all the splits and views share. A view renames or drops the organisms, as the
+derived trees did, e.g. SplitDataset(root, "split.csv", "train", "Merged", view) with the view
+
+    None                    split/train
+    dichotomy("E.coli")     split_Dichotomies_merged/E.coli/train
+    by_order()              split_by_order/train
+    in_order("Bacillales")  split_by_order/split_in_Bacillales/train
+
+The store holds either single-diameter images or merged images. "Merged" features of a store of
+single-diameter images are gathered as VirtualMergedDataset gathers them, with the images paired
+within the fold only, so an image never takes part in both folds.
+
+The experiments of Utils.runner read their folds this way when their config entry has a "split",
+see Utils.scheduler.load_dataset(). materialize() still writes the tree of a view for the scripts
+that read folders, with hard links.
+"""
+import glob
+import os
+import shutil
+import zlib
+
+import numpy as np
+import pandas as pd
+
+from Utils.dataset import Dataset, parse_filename
+from Utils.features import FEATURE_DTYPES, compact_features
+from Utils.ingest import DIAMETERS, pairing, scan
+from Utils.io import read_files
+from Utils.names import BLANK, CONCENTRATIONS, ORDER_TO_SPECIES, ORDERS, OTHERS
+
+MANIFEST_COLUMNS = ["file", "organism", "fold"]
+
+
+def split_groups(root):
+    """
+    The groups of images that are split separately, as "split dataset.py" groups them: every
+    concentration and diameter of an organism, every diameter of the Blank. The images of a store
+    of merged images have no diameter, they are grouped by concentration with the diameter None.
+
+    Returns:
+        A dict {(organism, concentration, diameter): [files]}, the files sorted.
+    """
+    groups = {}
+    for organism in sorted(os.listdir(root)):
+        blank = organism in (BLANK, "Blank")
+        for file in sorted(glob.glob(os.path.join(root, organism, "*.tif"))):
+            diameter, concentration, _ = parse_filename(file)
+            if diameter not in DIAMETERS:
+                diameter = None
+            if blank or concentration not in CONCENTRATIONS:
+                concentration = None
+            groups.setdefault((organism, concentration, diameter), []).append(file)
+    return groups
+
+
+def make_split(root, ratio=0.2, seed=0):
+    """
+    Split the images under root into a train and a test fold.
+
+    Every group of split_groups() is shuffled by its own generator, seeded by seed and the name of
+    the group, and its first int(n * ratio) images are the test fold. The split is reproducible,
+    and the images added to one group do not change the split of the others.
+
+    Args:
+        root: The canonical image store, one folder per organism.
+        ratio: The ratio of the test fold, the default is 0.2.
+        seed: The seed, the default is 0.
+
+    Returns:
+        The manifest, a DataFrame with the columns file (relative to root), organism and fold.
+    """
+    return _split(split_groups(root), root, ratio, seed)
+
+
+def split_raw(root, ratio=0.2, seed=0):
+    """
+    Split the raw 16-bit images of Utils.ingest.scan() into a train and a test fold, for ingest().
+
+    Every organism, concentration and diameter is split separately, as make_split() splits its
+    groups, so the diameters of a group keep the same number of images in every fold and the
+    images of a fold can be merged with each other.
+
+    Args:
+        root: The folder of the raw images, see Utils.ingest.scan().
+        ratio: The ratio of the test fold, the default is 0.2.
+        seed: The seed, the default is 0.
+
+    Returns:
+        The manifest, a DataFrame with the columns file (relative to root), organism and fold.
+    """
+    groups = {(organism, concentration, diameter): files
+              for (organism, concentration), group in scan(root).items() for diameter, files in group.items()}
+    return _split(groups, root, ratio, seed)
+
+
+def _split(groups, root, ratio, seed):
+    rows = []
+    for key, files in groups.items():
+        rng = np.random.default_rng([seed, zlib.crc32(repr(key).encode("utf-8"))])
+        num = int(len(files) * ratio)
+        for rank, i in enumerate(rng.permutation(len(files))):
+            rows.append([os.path.relpath(files[i], root), key[0], "test" if rank < num else "train"])
+    return pd.DataFrame(rows, columns=MANIFEST_COLUMNS)
+
+
+def load_split(manifest):
+    """A manifest, given as a DataFrame or the path of its csv."""
+    return manifest if isinstance(manifest, pd.DataFrame) else pd.read_csv(manifest)
+
+
+def dichotomy(target):
+    """The view of a Dichotomies model: the target and the Blank against all the other organisms, named OTHERS."""
+    return lambda organism: organism if organism in (target, BLANK) else OTHERS
+
+
+def by_order():
+    """The view of the order model: every species is named after its order."""
+    orders = {species: order for order in ORDERS for species in ORDER_TO_SPECIES.get(order, [order])}
+    orders[BLANK] = BLANK
+    return lambda organism: orders.get(organism, organism)
+
+
+def in_order(order):
+    """The view of the species model of an order: the species of the order, the others are dropped."""
+    species = set(ORDER_TO_SPECIES[order])
+    return lambda organism: organism if organism in species else None
+
+
+VIEWS = {"dichotomy": dichotomy, "by_order": by_order, "in_order": in_order}
+
+
+def view_of(name=None, *args):
+    """The view called name in VIEWS, built with args, e.g. view_of("dichotomy", "E.coli"). None keeps the organisms."""
+    return None if name is None else VIEWS[name](*args)
+
+
+def fold_triples(files, organisms):
+    """
+    The rows of the 5nm, 13nm and 60nm images of every merged image, pairing the given images only,
+    as merge_triples() pairs the images of a folder.
+
+    Args:
+        files: The single-diameter images of one fold.
+        organisms: The organism of every image.
+
+    Returns:
+        triples: A ndarray of shape (n_merged, 3) with the positions in files of the three images of
+         every merged image.
+        names: The paths the merged images would have, "<organism folder>/<concentration>_<k>.tif".
+        organisms: The organism of every merged image.
+    """
+    groups = {}
+    for i, (file, organism) in enumerate(zip(files, organisms)):
+        diameter, concentration, _ = parse_filename(file)
+        blank = organism in (BLANK, "Blank")
+        key = (organism, os.path.dirname(file), "blank" if blank else concentration)
+        groups.setdefault(key, {d: [] for d in DIAMETERS}).setdefault(diameter, []).append(i)
+    triples, names, merged = [], [], []
+    for (organism, folder, concentration), group in sorted(groups.items()):
+        group = [sorted(group[d], key=lambda i: files[i]) for d in DIAMETERS]
+        for k, rank in enumerate(pairing(min(len(images) for images in group))):
+            triples.append([group[d][r] for d, r in enumerate(rank)])
+            names.append(os.path.join(folder, f"{concentration}_{k}.tif"))
+            merged.append(organism)
+    return np.array(triples, dtype=np.intp).reshape(-1, 3), names, merged
+
+
+class SplitDataset(Dataset):
+    """
+    One fold of a split manifest, read from the canonical image store.
+
+    The organisms are the names given by the view, sorted, so the labels are the same on every
+    system. Everything else behaves as Dataset on the tree "split dataset.py" would have copied.
+    The "Merged" features of a store of single-diameter images are gathered from their single
+    histograms, see fold_triples(), and so is "VirtualMerged" on any store.
+
+    Args:
+        root: The canonical image store the manifest refers to.
+        manifest: The manifest, or the path of its csv, see make_split().
+        fold: "train" or "test".
+        model_type: The form of data accepted by the model. It can be "Single", "Merged" or "VirtualMerged".
+        view: A function that maps an organism to its class name, or None to drop it. The default
+         is None, which keeps the organisms.
+        feature_num: The number of gray values (features) for each gray histogram, the default is 225.
+        cache: Whether to reuse the histograms stored by FeatureCache, the default is True.
+        workers: The number of threads used to decode the images, the default is None.
+        dtype: The dtype the histograms are stored in, see compact_features(). The default is None.
+    """
+
+    def __init__(self, root, manifest, fold, model_type, view=None, feature_num=225, cache=True, workers=None,
+                 dtype=None):
+        self.path = root
+        self.model_type = "Merged" if model_type == "VirtualMerged" else model_type
+        self.feature_num = feature_num
+        self.triples = None
+
+        manifest = load_split(manifest)
+        manifest = manifest[manifest["fold"] == fold]
+        names = manifest["organism"].map(view) if view is not None else manifest["organism"]
+        keep = names.notna().to_numpy()
+        files = [os.path.join(root, file) for file in manifest["file"][keep]]
+        names = list(names[keep])
+        self.organisms = sorted(set(names))
+
+        merged_from_single = model_type == "Merged" and any(parse_filename(file)[0] in DIAMETERS for file in files)
+        if model_type == "VirtualMerged" or merged_from_single:
+            self.singles = read_files(root, files, "Single", feature_num, cache, workers)
+            self.singles = compact_features(self.singles, dtype or FEATURE_DTYPES["Merged"])
+            self.single_files = files
+            self.triples, files, names = fold_triples(files, names)
+        else:
+            self._X = compact_features(read_files(root, files, model_type, feature_num, cache, workers), dtype)
+        diameters, concentrations, batches = zip(*map(parse_filename, files)) if files else ((), (), ())
+        self.meta = pd.DataFrame({
+            "file": files,
+            "organism": names,
+            "diameter": diameters,
+            "concentration": concentrations,
+            "batch": batches,
+        })
+
+    @property
+    def X(self):
+        return self._X if self.triples is None else self.rows(slice(None))
+
+    def rows(self, mask):
+        """The histograms of the images selected by mask, gathered from the single histograms for merged folds."""
+        if self.triples is None:
+            return self._X[mask]
+        triples = self.triples[mask]
+        return self.singles[triples].reshape(len(triples), 3 * self.feature_num)
+
+    def sources(self, mask):
+        """The image files the rows selected by mask are read from, the three single images of a merged row."""
+        if self.triples is None:
+            return super().sources(mask)
+        return [tuple(self.single_files[i] for i in triple) for triple in self.triples[mask]]
+
+
+def materialize(root, manifest, output, view=None):
+    """
+    Write the train/ and test/ trees of a split under output, for the scripts that read folders.
+    The images are hard links to the store, or copies where links are not possible.
+
+    Args:
+        root: The canonical image store the manifest refers to.
+        manifest: The manifest, or the path of its csv.
+        output: The folder of the trees.
+        view: The view of the organisms, see SplitDataset.
+    """
+    manifest = load_split(manifest)
+    for file, organism, fold in manifest[MANIFEST_COLUMNS].itertuples(index=False):
+        name = view(organism) if view is not None else organism
+        if name is None:
+            continue
+        folder = os.path.join(output, fold, name)
+        os.makedirs(folder, exist_ok=True)
+        target = os.path.join(folder, os.path.basename(file))
+        if os.path.exists(target):
+            continue
+        try:
+            os.link(os.path.join(root, file), target)
+        except OSError:
+            shutil.copy2(os.path.join(root, file), target)
@@ -0,0 +1,208 @@
+"""
+Hyperparameter search that writes the params/*.json files of the experiments of Utils.runner.
+
+The candidates are compared by successive halving over the folds of StratifiedKFold: every round
+scores the remaining candidates on more folds and keeps the best 1/factor of them, until one
+candidate is left or all the folds are used. The scores of a fold are kept, so a candidate is never
+evaluated twice on the same fold.
+
+Candidates that only differ in their LDA or in n_components share the decomposition: on each fold
+the PCA/KernelPCA is fitted once with the largest n_components of the group, and every candidate
+uses the first n_components columns of its projection (the components of PCA and KernelPCA are
+nested, up to the precision of the randomized and arpack solvers). The RandomForest candidates that only differ in n_estimators are scored by growing one
+forest with warm_start, from the smallest n_estimators to the largest. The folds and groups are
+evaluated in parallel by joblib, on the training data memory-mapped by shared().
+
+Usage:
+    python -m Utils.tuning [config] [--only PCA_LDA/nine_single ...] [--n_splits 5] [--factor 3]
+"""
+import argparse
+import itertools
+import json
+import math
+
+import numpy as np
+from joblib import Parallel, delayed
+from sklearn.decomposition import PCA, KernelPCA
+from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.metrics import accuracy_score
+
+from Utils.evaluate import cv_splits
+from Utils.io import shared
+from Utils.runner import CONFIG, plan
+from Utils.scheduler import load_dataset
+
+SEARCH_SPACES = {
+    "pca_lda": {
+        "pca": {"n_components": list(range(5, 61, 5))},
+        "lda": {"solver": ["svd", "eigen"]},
+    },
+    "kernel_pca_lda": {
+        "pca": {"kernel": ["linear"], "n_components": list(range(10, 101, 5))},
+        "lda": {"solver": ["svd", "eigen"]},
+    },
+    "random_forest": {
+        "rf": {"n_estimators": [20, 40, 80, 120, 160, 200], "max_features": ["sqrt", 0.05, 0.1, 0.2],
+               "max_depth": [None, 8, 16], "random_state": [100]},
+    },
+}
+
+
+def expand(space):
+    """All the combinations of a {name: [values]} space, as a list of dicts."""
+    keys = sorted(space)
+    return [dict(zip(keys, values)) for values in itertools.product(*(space[key] for key in keys))]
+
+
+def candidates_of(estimator, space, n_classes, n_samples, n_features):
+    """
+    Expand the search space of an estimator into its candidates.
+
+    Returns:
+        A list of dicts {"pca": ..., "lda": ...} or {"rf": ...}.
+    """
+    if estimator == "random_forest":
+        return [{"rf": params} for params in expand(space["rf"])]
+    # the number of components can not exceed the number of samples or features of a training fold
+    limit = min(n_samples, n_features)
+    pcas = [params for params in expand(space["pca"]) if params["n_components"] < limit]
+    ldas = [dict(params, n_components=min(2, n_classes - 1)) for params in expand(space["lda"])]
+    return [{"pca": pca, "lda": lda} for pca in pcas for lda in ldas]
+
+
+def group_key(estimator, candidate):
+    """The candidates of a group share one decomposition (or one warm-started forest) per fold."""
+    if estimator == "random_forest":
+        return json.dumps({k: v for k, v in candidate["rf"].items() if k != "n_estimators"}, sort_keys=True)
+    return json.dumps({k: v for k, v in candidate["pca"].items() if k != "n_components"}, sort_keys=True)
+
+
+def score_linear_group(estimator, candidates, X, y, train, test):
+    """Score PCA/KernelPCA -> LDA candidates that share their decomposition on one fold."""
+    projection = PCA if estimator == "pca_lda" else KernelPCA
+    n_components = max(candidate["pca"]["n_components"] for _, candidate in candidates)
+    pca = projection(**dict(candidates[0][1]["pca"], n_components=n_components)).fit(X[train])
+    Z_train, Z_test = pca.transform(X[train]), pca.transform(X[test])
+
+    scores = {}
+    for index, candidate in candidates:
+        k = candidate["pca"]["n_components"]
+        lda = LinearDiscriminantAnalysis(**candidate["lda"]).fit(Z_train[:, :k], y[train])
+        scores[index] = accuracy_score(y[test], lda.predict(Z_test[:, :k]))
+    return scores
+
+
+def score_forest_group(candidates, X, y, train, test):
+    """Score RandomForest candidates that only differ in n_estimators by growing one forest."""
+    model = RandomForestClassifier(**dict(candidates[0][1]["rf"], warm_start=True, n_jobs=1))
+    scores = {}
+    for index, candidate in sorted(candidates, key=lambda c: c[1]["rf"]["n_estimators"]):
+        model.set_params(n_estimators=candidate["rf"]["n_estimators"]).fit(X[train], y[train])
+        scores[index] = accuracy_score(y[test], model.predict(X[test]))
+    return scores
+
+
+def successive_halving(estimator, candidates, X, y, n_splits=5, factor=3, min_folds=1, n_jobs=-1):
+    """
+    Find the best candidate by successive halving over the folds.
+
+    Args:
+        estimator: "pca_lda", "kernel_pca_lda" or "random_forest".
+        candidates: The candidates, see candidates_of().
+        X: Features of the training data.
+        y: Labels of the training data.
+        n_splits: The number of folds of StratifiedKFold, the default is 5.
+        factor: 1/factor of the candidates survive every round, and the number of folds is
+         multiplied by factor, the default is 3.
+        min_folds: The number of folds of the first round, the default is 1.
+        n_jobs: The number of (fold, group) evaluations run in parallel, the default is -1.
+
+    Returns:
+        best: The best candidate.
+        mean_scores: A dict that maps the index of every candidate of the last round to its mean
+         score on the folds of that round.
+    """
+    splits = cv_splits(y, n_splits)
+    fold_scores = {}
+    alive = list(range(len(candidates)))
+    n_folds = min(min_folds, n_splits)
+    while True:
+        folds, jobs = [], []
+        for fold in range(n_folds):
+            groups = {}
+            for index in alive:
+                if (index, fold) not in fold_scores:
+                    groups.setdefault(group_key(estimator, candidates[index]), []).append((index, candidates[index]))
+            train, test = splits[fold]
+            for group in groups.values():
+                folds.append(fold)
+                if estimator == "random_forest":
+                    jobs.append(delayed(score_forest_group)(group, X, y, train, test))
+                else:
+                    jobs.append(delayed(score_linear_group)(estimator, group, X, y, train, test))
+        for fold, scores in zip(folds, Parallel(n_jobs=n_jobs)(jobs)):
+            for index, score in scores.items():
+                fold_scores[index, fold] = score
+
+        mean_scores = {index: np.mean([fold_scores[index, fold] for fold in range(n_folds)]) for index in alive}
+        print(f"{len(alive)} candidates on {n_folds} folds, best {max(mean_scores.values()):.4f}")
+        if len(alive) == 1 or n_folds == n_splits:
+            break
+        alive = sorted(alive, key=lambda index: -mean_scores[index])[:max(1, math.ceil(len(alive) / factor))]
+        n_folds = min(n_folds * factor, n_splits)
+
+    best = max(alive, key=lambda index: mean_scores[index])
+    return candidates[best], mean_scores
+
+
+def full_params(estimator, candidate):
+    """The complete parameters of the estimators of a candidate, as stored in the params files."""
+    if estimator == "random_forest":
+        return {"": RandomForestClassifier(**candidate["rf"]).get_params()}
+    projection = PCA if estimator == "pca_lda" else KernelPCA
+    return {"_pca": projection(**candidate["pca"]).get_params(),
+            "_lda": LinearDiscriminantAnalysis(**candidate["lda"]).get_params()}
+
+
+def tune(experiment, n_splits=5, factor=3, n_jobs=-1):
+    """
+    Search the parameters of an experiment on its training data and write its params files.
+
+    Args:
+        experiment: An Experiment of Utils.runner.
+        n_splits: The number of folds, the default is 5.
+        factor: The halving factor, the default is 3.
+        n_jobs: The number of evaluations run in parallel, the default is -1.
+
+    Returns:
+        The best candidate.
+    """
+    estimator = experiment.spec["estimator"]
+    X, y = load_dataset(*experiment.dataset_args("train")).subset(experiment.concentration)
+    space = dict(SEARCH_SPACES[estimator], **experiment.spec.get("search", {}))
+    n_train = len(y) - math.ceil(len(y) / n_splits)
+    candidates = candidates_of(estimator, space, len(np.unique(y)), n_train, X.shape[1])
+    print(f"{experiment.name}: {len(candidates)} candidates")
+    with shared(np.asarray(X, dtype=np.float64)) as X:
+        best, _ = successive_halving(estimator, candidates, X, y, n_splits, factor, n_jobs=n_jobs)
+
+    for suffix, params in full_params(estimator, best).items():
+        with open(experiment.path("params", f"{experiment.name}{suffix}.json"), "w") as f:
+            json.dump(params, f, indent=4)
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tune the parameters of the experiments described by a config.")
+    parser.add_argument("config", nargs="?", default=CONFIG)
+    parser.add_argument("--only", nargs="*", default=None)
+    parser.add_argument("--n_splits", type=int, default=5)
+    parser.add_argument("--factor", type=int, default=3)
+    parser.add_argument("--n_jobs", type=int, default=-1)
+    args = parser.parse_args()
+    with open(args.config, "r") as f:
+        config = json.load(f)
+    for experiment in plan(config, args.only):
+        if experiment.trained:
+            tune(experiment, args.n_splits, args.factor, args.n_jobs)
@@ -0,0 +1,60 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from Utils.cache import FeatureCache
+
+
+def make_root(root, n):
+    os.makedirs(root, exist_ok=True)
+    for i in range(n):
+        if os.path.exists(os.path.join(root, f"{i:03d}.tif")):
+            continue
+        with open(os.path.join(root, f"{i:03d}.tif"), "w") as f:
+            f.write("x" * (i + 1))
+
+
+def extract(files, log=None):
+    if log is not None:
+        with open(log, "a") as f:
+            f.write(f"{len(files)}\n")
+        time.sleep(0.1)
+    return np.array([[int(os.path.basename(file)[:3])] * 4 for file in files], dtype=np.float32)
+
+
+def read(root, cache, log=None):
+    files = sorted(os.path.join(root, file) for file in os.listdir(root))
+    return FeatureCache(root, "Single", 4, cache).get(files, lambda missing: extract(missing, log))
+
+
+def calls(log):
+    with open(log, "r") as f:
+        return [int(x) for x in f.read().split()]
+
+
+def test_only_missing_rows_are_extracted(tmp_path):
+    root, cache, log = str(tmp_path / "root"), str(tmp_path / "cache"), str(tmp_path / "log")
+    make_root(root, 10)
+    np.testing.assert_array_equal(read(root, cache, log)[:, 0], np.arange(10))
+    np.testing.assert_array_equal(read(root, cache, log)[:, 0], np.arange(10))
+    assert calls(log) == [10]
+
+    # a changed image and new images are appended, the other rows are reused
+    time.sleep(0.01)
+    with open(os.path.join(root, "003.tif"), "w") as f:
+        f.write("changed")
+    make_root(root, 12)
+    np.testing.assert_array_equal(read(root, cache, log)[:, 0], np.arange(12))
+    assert calls(log) == [10, 3]
+
+
+def test_concurrent_writers_extract_once(tmp_path):
+    root, cache, log = str(tmp_path / "root"), str(tmp_path / "cache"), str(tmp_path / "log")
+    make_root(root, 20)
+    with ProcessPoolExecutor(4) as executor:
+        results = list(executor.map(read, [root] * 4, [cache] * 4, [log] * 4))
+    for features in results:
+        np.testing.assert_array_equal(features[:, 0], np.arange(20))
+    assert calls(log) == [20]
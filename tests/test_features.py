@@ -0,0 +1,90 @@
+"""
+Every fast feature path must give the output of the reference implementation, trans_to_single_glh()
+and trans_to_merged_glh(), in value and dtype.
+
+The batch engine is checked on the image stacks directly. The serial, parallel and cached read_img
+are checked on the same images written as TIFF files to a temporary dataset.
+"""
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+from Utils.features import GRAY_LEVELS, batch_histograms, trans_to_merged_glh, trans_to_single_glh
+from Utils.io import list_img, read_img
+
+CHANNELS = {"Single": 1, "Merged": 3}
+
+
+def synthetic_images(n=24, channels=3, seed=0):
+    """
+    A reproducible stack of 256x256 uint8 images that covers the edge cases of the binning: random
+    noise, the gray values 0, 224, 225 and 255, and a constant image.
+    """
+    rng = np.random.default_rng(seed)
+    images = rng.integers(0, GRAY_LEVELS, (n, 256, 256, channels), dtype=np.uint8)
+    images[1] = rng.choice(np.array([0, 224, 225, 255], dtype=np.uint8), images[1].shape)
+    images[2] = 255
+    images[3, :128] = 224
+    images[4] = np.arange(256, dtype=np.uint8)[:, np.newaxis, np.newaxis]
+    return images[..., 0] if channels == 1 else images
+
+
+def reference_features(images, model_type, feature_num):
+    trans = trans_to_single_glh if model_type == "Single" else trans_to_merged_glh
+    return np.array([trans(np.ascontiguousarray(img), feature_num) for img in images])
+
+
+@pytest.fixture(scope="module", params=["Single", "Merged"])
+def dataset(request, tmp_path_factory):
+    """The synthetic images of a model_type, and the folder they are written to as TIFF files."""
+    model_type = request.param
+    images = synthetic_images(channels=CHANNELS[model_type])
+    root = tmp_path_factory.mktemp(model_type)
+    os.mkdir(root / "organism")
+    for i, img in enumerate(images):
+        cv2.imwrite(str(root / "organism" / f"{i:03d}.tif"), img)
+    return model_type, images, str(root)
+
+
+def in_file_order(features, root):
+    """read_img follows the order of glob, the synthetic images follow the file names."""
+    files, _ = list_img(root)
+    order = [int(os.path.basename(file)[:3]) for file in files]
+    return features[np.argsort(order)]
+
+
+def assert_same(features, golden):
+    assert features.dtype == golden.dtype
+    np.testing.assert_array_equal(features, golden)
+
+
+@pytest.mark.parametrize("feature_num", [225, 256])
+def test_batch_histograms(dataset, feature_num):
+    model_type, images, _ = dataset
+    assert_same(batch_histograms(images, model_type, feature_num, chunk_size=5),
+                reference_features(images, model_type, feature_num))
+
+
+def test_batch_histograms_rejects_wider_images():
+    with pytest.raises(ValueError, match="uint16"):
+        batch_histograms(np.full((2, 256, 256), 300, dtype=np.uint16), "Single")
+
+
+@pytest.mark.parametrize("feature_num", [225, 256])
+@pytest.mark.parametrize("workers", [None, 4])
+def test_read_img(dataset, feature_num, workers):
+    model_type, images, root = dataset
+    features, _ = read_img(root, model_type, feature_num=feature_num, cache=False, workers=workers)
+    assert_same(in_file_order(features, root), reference_features(images, model_type, feature_num))
+
+
+@pytest.mark.parametrize("feature_num", [225, 256])
+def test_read_img_cache(dataset, feature_num, tmp_path):
+    model_type, images, root = dataset
+    golden = reference_features(images, model_type, feature_num)
+    cold, _ = read_img(root, model_type, feature_num=feature_num, cache=str(tmp_path))
+    warm, _ = read_img(root, model_type, feature_num=feature_num, cache=str(tmp_path))
+    assert_same(in_file_order(cold, root), golden)
+    assert_same(in_file_order(warm, root), golden)
@@ -0,0 +1,41 @@
+import os
+
+import cv2
+import numpy as np
+
+from Utils.ingest import DIAMETERS, ingest
+from Utils.splits import split_raw
+
+
+def make_raw(root, n=10):
+    rng = np.random.default_rng(0)
+    for organism, concentrations in (("E.coli", ["10^4", "10^5"]), ("xBlank", [None])):
+        for concentration in concentrations:
+            for diameter in DIAMETERS:
+                folder = os.path.join(root, organism, *([concentration] if concentration else []), diameter, "batch1")
+                os.makedirs(folder)
+                for i in range(n):
+                    img = rng.integers(0, 4096, (40, 40), dtype=np.uint16)
+                    cv2.imwrite(os.path.join(folder, f"untitled{i:03d}.tif"), img)
+
+
+def test_images_are_paired_within_their_fold(tmp_path, monkeypatch):
+    monkeypatch.setenv("FEATURE_CACHE_DIR", str(tmp_path / "cache"))
+    raw, output = str(tmp_path / "raw"), str(tmp_path / "merged")
+    make_raw(raw)
+    manifest = split_raw(raw, 0.2, seed=1)
+    assert manifest.equals(split_raw(raw, 0.2, seed=1))
+    X, meta = ingest(raw, output, workers=2, tiff=True, manifest=manifest)
+
+    fold_of = dict(zip(manifest["file"], manifest["fold"]))
+    for fold, sources in zip(meta["fold"], meta[list(DIAMETERS)].to_numpy()):
+        assert {fold_of[source] for source in sources} == {fold}
+    assert sorted(meta["fold"].unique()) == ["test", "train"]
+    # 2 of 10 images of every diameter are test images, paired three times
+    assert (meta["fold"] == "test").sum() == 3 * 3 * 2
+    assert len(X) == 3 * 3 * 10
+    assert os.path.isdir(os.path.join(output, "test", "E.coli"))
+
+    # without a manifest the whole tree is paired, as before
+    X_all, meta_all = ingest(raw, str(tmp_path / "all"), workers=2)
+    assert meta_all["fold"].isna().all() and len(X_all) == len(X)
@@ -0,0 +1,30 @@
+import os
+
+import numpy as np
+
+from Utils.io import shared, shared_array
+
+
+def test_shared_files_are_named_by_shape_and_dtype():
+    X = np.zeros((4, 6))
+    with shared(X) as a, shared(X.reshape(6, 4)) as b, shared(X.astype(np.float32)) as c:
+        paths = {a.filename, b.filename, c.filename}
+        assert len(paths) == 3
+        np.testing.assert_array_equal(a, X)
+        assert b.shape == (6, 4) and c.dtype == np.float32
+    assert not any(os.path.exists(path) for path in paths)
+
+
+def test_shared_files_are_removed_after_the_last_block():
+    X = np.arange(12.0).reshape(3, 4)
+    with shared(X) as outer:
+        with shared(X.copy()) as inner:
+            assert inner.filename == outer.filename
+        assert os.path.exists(outer.filename)
+    assert not os.path.exists(outer.filename)
+
+    # an array handed out by shared_array() is kept until the process exits
+    pinned = shared_array(X + 1)
+    with shared(X + 1) as a:
+        assert a.filename == pinned.filename
+    assert os.path.exists(pinned.filename)
@@ -0,0 +1,50 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import pytest
+
+from Utils.results import ResultsStore
+
+
+def export(path):
+    ResultsStore(path).export()
+
+
+def test_concurrent_exports_write_every_row_once(tmp_path):
+    store = ResultsStore(str(tmp_path / "store.sqlite"))
+    table = str(tmp_path / "table.xlsx")
+    for i in range(50):
+        store.insert([i, i * 2], table, ["a", "b"])
+    with ProcessPoolExecutor(4) as executor:
+        list(executor.map(export, [store.path] * 8))
+    df = pd.read_excel(table)
+    assert list(df["a"]) == list(range(50))
+
+    store.insert([50, 100], table)
+    store.export(table)
+    assert list(pd.read_excel(table)["b"]) == [i * 2 for i in range(51)]
+    assert not [file for file in os.listdir(tmp_path) if file.startswith(".")]
+
+
+def test_export_stopped_before_commit_is_redone(tmp_path, monkeypatch):
+    store = ResultsStore(str(tmp_path / "store.sqlite"))
+    table = str(tmp_path / "table.xlsx")
+    pd.DataFrame({"a": [-1], "b": [-2]}).to_excel(table, index=False)
+    store.insert([0, 0], table)
+    store.export(table)
+
+    # the table is replaced, then the export fails before the rows are marked as exported
+    store.insert([1, 2], table)
+    replace = os.replace
+
+    def replace_then_fail(src, dst):
+        replace(src, dst)
+        raise OSError("stopped")
+
+    monkeypatch.setattr(os, "replace", replace_then_fail)
+    with pytest.raises(OSError):
+        store.export(table)
+    monkeypatch.setattr(os, "replace", replace)
+    store.export(table)
+    assert list(pd.read_excel(table)["a"]) == [-1, 0, 1]
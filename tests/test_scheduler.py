@@ -0,0 +1,47 @@
+import os
+
+import pandas as pd
+import pytest
+
+from Utils.io import insert_into_table, save_model
+from Utils.results import append_line, commit, deferred
+from Utils.scheduler import Task, run_tasks
+
+
+def work(folder, name, fail, n_jobs=1):
+    insert_into_table([name, n_jobs], os.path.join(folder, "table.xlsx"), ["name", "n_jobs"])
+    append_line(os.path.join(folder, "lines.txt"), name)
+    if fail and not os.path.exists(os.path.join(folder, "fixed")):
+        raise ValueError(f"{name} failed")
+    save_model(name, os.path.join(folder, f"{name}.pkl"))
+
+
+def make_tasks(folder):
+    return [Task(name, work, (folder, name, name == "b"), outputs=[os.path.join(folder, f"{name}.pkl")],
+                 tables=[os.path.join(folder, "table.xlsx")]) for name in "abc"]
+
+
+@pytest.mark.parametrize("n_workers", [1, 2])
+def test_only_succeeded_tasks_store_results(tmp_path, n_workers):
+    folder = str(tmp_path)
+    with pytest.raises(RuntimeError, match="1 tasks failed: b"):
+        run_tasks(make_tasks(folder), n_workers=n_workers, cpu_budget=2)
+    assert sorted(pd.read_excel(os.path.join(folder, "table.xlsx"))["name"]) == ["a", "c"]
+
+    # the re-run only runs the failed task, and adds its results once
+    open(os.path.join(folder, "fixed"), "w").close()
+    run_tasks(make_tasks(folder), n_workers=n_workers, cpu_budget=2)
+    assert sorted(pd.read_excel(os.path.join(folder, "table.xlsx"))["name"]) == ["a", "b", "c"]
+    with open(os.path.join(folder, "lines.txt")) as f:
+        assert sorted(f.read().split()) == ["a", "b", "c"]
+
+
+def test_model_is_put_in_place_after_the_rows(tmp_path):
+    folder = str(tmp_path)
+    with deferred() as results:
+        work(folder, "a", False)
+    assert not os.path.exists(os.path.join(folder, "a.pkl"))
+    assert [kind for kind, *_ in results] == ["row", "line", "file"]
+    commit(results)
+    assert os.path.exists(os.path.join(folder, "a.pkl"))
+    assert not [file for file in os.listdir(folder) if file.startswith(".") and file.endswith(".pkl")]
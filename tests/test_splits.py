@@ -0,0 +1,66 @@
+import os
+
+import cv2
+import numpy as np
+
+from Utils.ingest import DIAMETERS
+from Utils.names import BLANK, OTHERS
+from Utils.splits import SplitDataset, dichotomy, make_split
+
+
+def make_store(root, merged=False, n=5):
+    rng = np.random.default_rng(0)
+    for organism, concentrations in (("E.coli", ["10^4", "10^5"]), ("S.aureus", ["10^4"]), (BLANK, [None])):
+        folder = os.path.join(root, organism)
+        os.makedirs(folder)
+        for concentration in concentrations:
+            prefix = "_".join(x for x in (organism, concentration) if x)
+            if merged:
+                for i in range(n):
+                    img = rng.integers(0, 256, (32, 32, 3), dtype=np.uint8)
+                    cv2.imwrite(os.path.join(folder, f"{concentration or 'blank'}_{i}.tif"), img)
+                continue
+            for diameter in DIAMETERS:
+                for i in range(n):
+                    img = rng.integers(0, 256, (32, 32), dtype=np.uint8)
+                    name = "_".join(x for x in (organism, diameter, concentration) if x)
+                    cv2.imwrite(os.path.join(folder, f"{name}_batch1_{i:03d}.tif"), img)
+
+
+def test_merged_store_is_split(tmp_path, monkeypatch):
+    monkeypatch.setenv("FEATURE_CACHE_DIR", str(tmp_path / "cache"))
+    root = str(tmp_path / "store")
+    make_store(root, merged=True)
+    manifest = make_split(root, 0.4, seed=0)
+    assert len(manifest) == 4 * 5
+    assert (manifest["fold"] == "test").sum() == 4 * 2
+
+    train = SplitDataset(root, manifest, "train", "Merged")
+    assert train.X.shape == (4 * 3, 3 * 225)
+
+
+def test_merged_fold_of_single_store(tmp_path, monkeypatch):
+    monkeypatch.setenv("FEATURE_CACHE_DIR", str(tmp_path / "cache"))
+    root = str(tmp_path / "store")
+    make_store(root)
+    manifest = make_split(root, 0.4, seed=0)
+    train_files = manifest.loc[manifest["fold"] == "train", "file"]
+
+    train = SplitDataset(root, manifest, "train", "Merged", dichotomy("E.coli"))
+    # 3 of 5 images of every diameter are train images, paired three times
+    assert train.X.shape == (4 * 9, 3 * 225)
+    assert train.organisms == sorted(["E.coli", BLANK, OTHERS])
+    # only the single images of the fold are read and paired
+    assert len(train.singles) == len(train_files)
+    assert len(np.unique(train.triples)) == len(train_files)
+    sources = train.sources(train.mask("all"))
+    assert {os.path.relpath(file, root) for row in sources for file in row} == set(train_files)
+
+    X, y = train.subset("10^4")
+    assert np.array_equal(X, train.X[train.mask("10^4")])
+    assert len(X) == 2 * 9 and set(y) == {0, 1}
+
+
+def test_dichotomy_keeps_the_blank():
+    view = dichotomy("E.coli")
+    assert [view(x) for x in ("E.coli", BLANK, "S.aureus")] == ["E.coli", BLANK, OTHERS]